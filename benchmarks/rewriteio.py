@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -
+#
+# This file is part of tproxy released under the MIT license.
+# See the NOTICE for more information.
+
+""" time small reads from a RewriteIO holding data received before the
+connection, as when a proxy script reads a request line by line.
+
+    $ python benchmarks/rewriteio.py
+"""
+
+import time
+
+from tproxy.rewrite import RewriteIO
+
+READ_SIZE = 64
+
+
+class NullSocket(object):
+
+    def recv_into(self, b):
+        return 0
+
+
+def run(size, chunks=4):
+    buf = ["x" * (size // chunks)] * chunks
+    pipe = RewriteIO(NullSocket(), None, buf=buf)
+    reads = 0
+    start = time.time()
+    while pipe.read(READ_SIZE):
+        reads += 1
+    return reads, time.time() - start
+
+
+def main():
+    for size in (4096, 65536, 1048576, 4194304):
+        reads, elapsed = run(size)
+        print "%8d bytes: %6d reads in %.4fs (%.2fus/read)" % (size,
+                reads, elapsed, elapsed * 1e6 / reads)
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,12 @@
 import re
+from tproxy import balancer
+
 re_host = re.compile("Host:\s*(.*)\r\n")
 
-class CouchDBRouter(object):
-    # look at the routing table and return a couchdb node to use
-    def lookup(self, name):
-        """ do something """
-        return ("127.0.0.1",5984)
-router = CouchDBRouter()
+# couchdb nodes on a consistent hash ring: a user always goes to the
+# same node and adding a node only moves the users it takes.
+balancer.register("couchdb", ["127.0.0.1:5984", "127.0.0.1:5985"],
+        policy="hash")
 
 # Perform content-aware routing based on the stream data. Here, the
 # Host header information from the HTTP protocol is parsed to find the 
@@ -17,6 +17,5 @@ router = CouchDBRouter()
 def proxy(data):
     matches = re_host.findall(data)
     if matches:
-        host = router.lookup(matches.pop()) 
-        return {"remote": host}
+        return {"pool": "couchdb", "hash_key": matches.pop()}
     return None
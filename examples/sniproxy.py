@@ -0,0 +1,19 @@
+# Route TLS connections by server name without terminating TLS.
+
+from tproxy.tls import parse_client_hello
+
+BACKENDS = {
+    "couchdb.local": ("127.0.0.1", 6984),
+}
+DEFAULT = ("encrypted.google.com", 443)
+
+def proxy(data):
+    try:
+        hello = parse_client_hello(data)
+    except ValueError:
+        return {"close": True}
+
+    if hello is None:
+        # wait for the full ClientHello
+        return
+    return {"remote": BACKENDS.get(hello.sni, DEFAULT)}
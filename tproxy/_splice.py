@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -
+#
+# This file is part of tproxy released under the MIT license.
+# See the NOTICE for more information.
+
+import os
+import sys
+
+try:
+    import ctypes
+    import ctypes.util
+except MemoryError:
+    # selinux execmem denial
+    # https://bugzilla.redhat.com/show_bug.cgi?id=488396
+    raise ImportError
+
+if not sys.platform.startswith('linux'):
+    raise ImportError("splice isn't supported on this platform")
+
+_libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+try:
+    _splice = _libc.splice
+except AttributeError:
+    raise ImportError("splice isn't supported by this libc")
+
+_splice.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int,
+        ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint]
+_splice.restype = ctypes.c_ssize_t
+
+SPLICE_F_MOVE = 1
+SPLICE_F_NONBLOCK = 2
+SPLICE_F_MORE = 4
+
+def splice(fdin, fdout, nbytes, flags=SPLICE_F_MOVE | SPLICE_F_NONBLOCK):
+    """ move up to `nbytes` from `fdin` to `fdout` without copying them
+    to user space. One of the two file descriptors must be a pipe. """
+    sent = _splice(fdin, None, fdout, None, nbytes, flags)
+    if sent == -1:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e))
+    return sent
@@ -60,7 +60,7 @@ class Application(object):
 
     def __init__(self):
         self.logger = None
-        self.cfg = Config("%prog [OPTIONS] script_path")
+        self.cfg = Config("%prog [OPTIONS] [script_path]")
         self.script = None
 
     def load_config(self):
@@ -68,11 +68,14 @@ class Application(object):
         parser = self.cfg.parser()
         opts, args = parser.parse_args()
 
-        if len(args) != 1:
+        if len(args) > 1 or (not args and not opts.routes):
             parser.error("No script or module specified.")
 
-        script_uri = args[0]
-        self.cfg.default_name = args[0]
+        if args:
+            script_uri = args[0]
+        else:
+            script_uri = None
+        self.cfg.default_name = script_uri or opts.routes
 
         # Load conf
         try:
@@ -85,7 +88,8 @@ class Application(object):
             os._exit(1)
 
         # setup script
-        self.script = Script(script_uri, cfg=self.cfg)
+        if script_uri is not None:
+            self.script = Script(script_uri, cfg=self.cfg)
         sys.path.insert(0, os.getcwd())
 
 
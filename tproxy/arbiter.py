@@ -16,8 +16,10 @@ from gevent import select
 
 from . import __version__
 from . import util
+from .health import HealthTable
 from .pidfile import Pidfile
 from .proxy import tcp_listener
+from .sslcontext import make_server_context
 from .worker import Worker
 
 
@@ -37,6 +39,8 @@ class Arbiter(object):
     START_CTX = {}
     
     LISTENER = None
+    HEALTH = None
+    SSL_CONTEXT = None
     WORKERS = {}    
     PIPE = []
 
@@ -63,6 +67,7 @@ class Arbiter(object):
         self.pidfile = None
         self.worker_age = 0
         self.reexec_pid = 0
+        self.ssl_context_created = 0
         self.master_name = "master"
         self.log = logging.getLogger(__name__)
 
@@ -93,6 +98,12 @@ class Arbiter(object):
         if not self.LISTENER:
             self.LISTENER = tcp_listener(self.address, self.cfg.backlog)
 
+        # shared with the workers so they see the same ejected remotes
+        if self.HEALTH is None:
+            self.HEALTH = HealthTable()
+
+        self.init_ssl_context()
+
         if self.cfg.pidfile is not None:
             self.pidfile = Pidfile(self.cfg.pidfile)
             self.pidfile.create(self.pid)
@@ -101,6 +112,20 @@ class Arbiter(object):
         self.log.info("tproxy %s started" % __version__)
         self.log.info("Listening on %s:%s" % self.address)
 
+    def init_ssl_context(self):
+        """ (re)create the ssl context inherited by the workers. A new
+        context gets new session ticket keys. """
+        self.SSL_CONTEXT = make_server_context(self.cfg)
+        self.ssl_context_created = time.time()
+
+    def rotate_ssl_context(self):
+        rotate = self.cfg.ssl_ticket_rotate
+        if self.SSL_CONTEXT is None or not rotate:
+            return
+        if time.time() - self.ssl_context_created >= rotate:
+            self.log.info("Rotating ssl session ticket keys")
+            self.reload()
+
     def init_signals(self):
         """\
         Initialize master signal handling. Most of the signals
@@ -131,6 +156,7 @@ class Arbiter(object):
                 if sig is None:
                     self.sleep()
                     self.murder_workers()
+                    self.rotate_ssl_context()
                     self.manage_workers()
                     continue
                 
@@ -311,6 +337,9 @@ class Arbiter(object):
         os.execvpe(self.START_CTX[0], self.START_CTX['args'], os.environ)
         
     def reload(self):
+        # new workers get new session ticket keys
+        self.init_ssl_context()
+
         # spawn new workers with new app & conf
         for i in range(self.cfg.workers):
             self.spawn_worker()
@@ -387,7 +416,8 @@ class Arbiter(object):
     def spawn_worker(self):
         self.worker_age += 1
         worker = Worker(self.worker_age, self.pid, self.LISTENER, self.cfg,
-                self.script)
+                self.script, health=self.HEALTH,
+                ssl_context=self.SSL_CONTEXT)
         pid = os.fork()
         if pid != 0:
             self.WORKERS[pid] = worker
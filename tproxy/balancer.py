@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -
+#
+# This file is part of tproxy released under the MIT license.
+# See the NOTICE for more information.
+
+from bisect import bisect
+import hashlib
+import math
+import random
+import struct
+import time
+
+from .util import parse_address
+
+# balancers registered by name in this worker
+_balancers = {}
+
+# cost of a host without latency sample, in seconds
+DEFAULT_LATENCY = 0.001
+
+_point = struct.Struct("<I")
+
+
+class Backend(object):
+    """ a remote host and the live counters used to select it """
+
+    __slots__ = ('addr', 'outstanding', 'latency', 'stamp', 'added',
+            'slow_start', 'decay')
+
+    def __init__(self, addr, slow_start=0, decay=10.0):
+        self.addr = parse_address(addr)
+        self.outstanding = 0
+        self.latency = 0.0
+        self.stamp = self.added = time.time()
+        self.slow_start = slow_start
+        self.decay = decay
+
+    def __repr__(self):
+        return "<Backend %s:%s outstanding=%s latency=%.4f>" % (
+                self.addr[0], self.addr[1], self.outstanding, self.latency)
+
+    def acquire(self):
+        self.outstanding += 1
+
+    def release(self):
+        self.outstanding -= 1
+
+    def observe(self, latency):
+        """ add a latency sample (connect or first byte) to the peak
+        EWMA. Peaks are taken immediately, decreases are smoothed over
+        `decay` seconds. """
+        now = time.time()
+        if latency > self.latency:
+            self.latency = latency
+        else:
+            w = math.exp(-(now - self.stamp) / self.decay)
+            self.latency = self.latency * w + latency * (1.0 - w)
+        self.stamp = now
+
+    def weight(self, now):
+        """ share of the traffic a host takes, ramping up from 0 to 1
+        during `slow_start` seconds after it has been added """
+        if not self.slow_start:
+            return 1.0
+        return max(min((now - self.added) / self.slow_start, 1.0), 0.01)
+
+    def load(self, now):
+        return (self.outstanding + 1) / self.weight(now)
+
+    def cost(self, now):
+        return (self.latency or DEFAULT_LATENCY) * self.load(now)
+
+
+class Balancer(object):
+    """ select a backend among a list of hosts """
+
+    def __init__(self, hosts, slow_start=0, decay=10.0):
+        self.slow_start = slow_start
+        self.decay = decay
+        self.backends = []
+        for host in hosts:
+            self.add(host)
+
+    def add(self, host):
+        self.backends.append(Backend(host, slow_start=self.slow_start,
+            decay=self.decay))
+
+    def remove(self, host):
+        addr = parse_address(host)
+        self.backends = [b for b in self.backends if b.addr != addr]
+
+    def candidates(self, health=None):
+        """ backends not ejected by `health`. All backends are returned
+        when they are all ejected. """
+        if health is None:
+            return self.backends
+
+        now = time.time()
+        healthy = [b for b in self.backends
+                if not health.is_ejected(b.addr, now)]
+        if len(healthy) == len(self.backends):
+            return self.backends
+        return healthy or self.backends
+
+    def select(self, key=None, health=None):
+        candidates = self.candidates(health)
+        if not candidates:
+            raise LookupError("no backend available")
+        return self.choose(candidates, key)
+
+    def choose(self, candidates, key):
+        raise NotImplementedError
+
+
+class LeastConnections(Balancer):
+    """ the host with the least outstanding connections """
+
+    def choose(self, candidates, key):
+        now = time.time()
+        return min(candidates, key=lambda b: b.load(now))
+
+
+class PeakEwma(Balancer):
+    """ the host with the lowest peak EWMA latency weighted by its
+    outstanding connections """
+
+    def choose(self, candidates, key):
+        now = time.time()
+        return min(candidates, key=lambda b: b.cost(now))
+
+
+class PowerOfTwo(Balancer):
+    """ the cheapest of two hosts chosen at random """
+
+    def choose(self, candidates, key):
+        if len(candidates) == 1:
+            return candidates[0]
+        now = time.time()
+        a, b = random.sample(candidates, 2)
+        if a.cost(now) <= b.cost(now):
+            return a
+        return b
+
+
+class HashRing(Balancer):
+    """ ketama-like consistent hashing with bounded loads.
+
+    Each host is placed `replicas` times on a ring of 32 bits points
+    computed once when hosts change, so adding or removing a host only
+    moves the keys it owns. A key goes to the first host following its
+    point on the ring that has less than `load_factor` times the
+    average number of connections. Without a key the least loaded host
+    is chosen. """
+
+    def __init__(self, hosts, replicas=160, load_factor=1.25, **options):
+        self.replicas = replicas
+        self.load_factor = load_factor
+        self.points = self.nodes = None
+        super(HashRing, self).__init__(hosts, **options)
+        self.build()
+
+    def add(self, host):
+        super(HashRing, self).add(host)
+        self.points = self.nodes = None
+
+    def remove(self, host):
+        super(HashRing, self).remove(host)
+        self.points = self.nodes = None
+
+    def build(self):
+        ring = []
+        for backend in self.backends:
+            name = "%s:%s" % backend.addr
+            for i in range(max(self.replicas // 4, 1)):
+                digest = hashlib.md5("%s-%s" % (name, i)).digest()
+                for j in range(4):
+                    ring.append((_point.unpack_from(digest, j * 4)[0],
+                        backend))
+        ring.sort(key=lambda point: point[0])
+        self.points = [point for point, _ in ring]
+        self.nodes = [backend for _, backend in ring]
+
+    def choose(self, candidates, key):
+        if key is None:
+            now = time.time()
+            return min(candidates, key=lambda b: b.load(now))
+
+        if self.nodes is None:
+            self.build()
+
+        if isinstance(key, unicode):
+            key = key.encode("utf-8")
+        point = _point.unpack_from(hashlib.md5(key).digest())[0]
+        start = bisect(self.points, point)
+
+        if self.load_factor:
+            total = sum(b.outstanding for b in candidates) + 1
+            capacity = math.ceil(self.load_factor * total / len(candidates))
+        else:
+            capacity = None
+
+        if candidates is not self.backends:
+            allowed = set(map(id, candidates))
+        else:
+            allowed = None
+
+        first = None
+        nodes = self.nodes
+        for i in xrange(len(nodes)):
+            backend = nodes[(start + i) % len(nodes)]
+            if allowed is not None and id(backend) not in allowed:
+                continue
+            if capacity is None or backend.outstanding < capacity:
+                return backend
+            if first is None:
+                first = backend
+        return first or candidates[0]
+
+
+POLICIES = {
+    "least_conn": LeastConnections,
+    "peak_ewma": PeakEwma,
+    "p2c": PowerOfTwo,
+    "hash": HashRing
+}
+
+def register(name, hosts, policy="p2c", **options):
+    """ register a balancer that a script can use by returning
+    ``{"pool": name}`` instead of a remote """
+    try:
+        balancer_class = POLICIES[policy]
+    except KeyError:
+        raise ValueError("unknown balancing policy: %r" % policy)
+
+    balancer = _balancers[name] = balancer_class(hosts, **options)
+    return balancer
+
+def get_balancer(name):
+    return _balancers[name]
+
+def all_backends():
+    for balancer in _balancers.values():
+        for backend in balancer.backends:
+            yield backend
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -
+#
+# This file is part of tproxy released under the MIT license.
+# See the NOTICE for more information.
+
+from .util import is_ssl_socket
+
+# max number of buffers given to sendmsg at once
+IOV_MAX = 1024
+
+
+class BufferPool(object):
+    """ pool of preallocated buffers reused between connections.
+
+    At most `maxsize` free buffers are kept so the memory held by the
+    pool is capped to `maxsize` x `size`. A buffer is allocated when the
+    pool is empty. """
+
+    def __init__(self, size, maxsize):
+        self.size = size
+        self.maxsize = maxsize
+        self._free = []
+
+    def get(self):
+        try:
+            return self._free.pop()
+        except IndexError:
+            return bytearray(self.size)
+
+    def put(self, buf):
+        if len(self._free) < self.maxsize:
+            self._free.append(buf)
+
+
+class ReceiveBuffer(object):
+    """ growable buffer filled with recv_into.
+
+    The buffer is never resized in place: when more room is needed the
+    data is copied to a new buffer twice as large, so memoryviews
+    returned by `view` stay valid. """
+
+    def __init__(self, size=1024):
+        self.buf = bytearray(size)
+        self.length = 0
+
+    def __len__(self):
+        return self.length
+
+    def recv(self, sock, size):
+        """ receive at most `size` bytes from `sock` at the end of the
+        buffer and return the number of bytes received """
+        if len(self.buf) - self.length < size:
+            buf = bytearray(max(2 * len(self.buf), self.length + size))
+            buf[:self.length] = memoryview(self.buf)[:self.length]
+            self.buf = buf
+
+        recved = sock.recv_into(memoryview(self.buf)[self.length:], size)
+        self.length += recved
+        return recved
+
+    def view(self, start=0, end=None):
+        if end is None:
+            end = self.length
+        return memoryview(self.buf)[start:end]
+
+    def getvalue(self):
+        return self.view().tobytes()
+
+
+def sendall(sock, data):
+    """ send a memoryview to a socket without copying it """
+    while data:
+        sent = sock.send(data)
+        data = data[sent:]
+
+def sendall_chunks(sock, chunks):
+    """ send a list of strings or buffers with as few calls as possible.
+    sendmsg gathers them without copying when available, otherwise they
+    are joined and sent at once. """
+    chunks = [chunk for chunk in chunks if chunk]
+    if not hasattr(sock, 'sendmsg') or is_ssl_socket(sock):
+        if len(chunks) == 1:
+            sock.sendall(chunks[0])
+        elif chunks:
+            sock.sendall("".join([chunk if isinstance(chunk, bytes)
+                else memoryview(chunk).tobytes() for chunk in chunks]))
+        return
+
+    views = [memoryview(chunk) for chunk in chunks]
+    while views:
+        sent = sock.sendmsg(views[:IOV_MAX])
+        while sent:
+            if sent >= len(views[0]):
+                sent -= len(views.pop(0))
+            else:
+                views[0] = views[0][sent:]
+                sent = 0
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -
+#
+# This file is part of tproxy released under the MIT license.
+# See the NOTICE for more information.
+
+from collections import OrderedDict
+import time
+
+
+class LRUCache(object):
+    """ mapping holding at most `maxsize` items. The least recently used
+    item is dropped when it's full.
+
+    Items can be given a time to live in seconds. `get` doesn't return
+    expired items but they are kept until they are overwritten or
+    dropped, so `entry` can still return them. `on_evict` is called
+    with the key and the value of the items dropped to make room. """
+
+    def __init__(self, maxsize=1024, on_evict=None):
+        self.maxsize = maxsize
+        self.on_evict = on_evict
+        self.items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def entry(self, key):
+        """ return (value, expires) for `key`, even expired, or None """
+        try:
+            entry = self.items.pop(key)
+        except KeyError:
+            return None
+        self.items[key] = entry
+        return entry
+
+    def get(self, key, default=None):
+        entry = self.entry(key)
+        if entry is None or (entry[1] is not None and
+                entry[1] <= time.time()):
+            self.misses += 1
+            return default
+        self.hits += 1
+        return entry[0]
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            expires = None
+        else:
+            expires = time.time() + ttl
+
+        self.items.pop(key, None)
+        if not self.maxsize:
+            return
+        if len(self.items) >= self.maxsize:
+            old_key, (old_value, _) = self.items.popitem(last=False)
+            if self.on_evict is not None:
+                self.on_evict(old_key, old_value)
+        self.items[key] = (value, expires)
+
+    def pop(self, key, default=None):
+        entry = self.items.pop(key, None)
+        if entry is None:
+            return default
+        return entry[0]
+
+    def clear(self):
+        self.items.clear()
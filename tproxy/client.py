@@ -5,23 +5,39 @@
 
 import logging
 import os
-import ssl
+import time
 
 import gevent
 from gevent import coros
 from gevent import socket
+from gevent.queue import Queue, Empty
 import greenlet
 
+from .balancer import get_balancer
+from .buffers import IOV_MAX, ReceiveBuffer, sendall_chunks
 from .server import ServerConnection, InactivityTimeout
-from .util import parse_address, is_ipv6
-from .sendfile import async_sendfile
+from .table import http_host
+from .tls import parse_client_hello
+from .upstream import pool_key
+from .util import parse_address
+from .sendfile import send_file, corked
 
 log = logging.getLogger(__name__)
 
+# delay before trying the next remote when several are given
+CONNECT_STAGGER = 0.25
+
+# size of the blocks read from file-like replies
+REPLY_READ_SIZE = 65536
+
 class ConnectionError(Exception):
     """ Exception raised when a connection is either rejected or a
     connection timeout occurs """
 
+class PreambleError(Exception):
+    """ Exception raised when the preamble is too large or takes too long
+    to be received """
+
 class ClientConnection(object):
 
     def __init__(self, sock, addr, worker):
@@ -30,9 +46,16 @@ class ClientConnection(object):
         self.worker = worker
 
         self.route = self.worker.route
+        self.cfg = self.route.cfg
+        self.preamble = ReceiveBuffer(self.cfg.preamble_read_size)
+        self.state = {}
+        self.fed = 0
         self.buf = []
         self.remote = None
+        self.backend = None
         self.connected = False
+        self.preamble_timer = None
+        self._tls_hello = None
         self._lock = coros.Semaphore()
 
     def handle(self):
@@ -40,12 +63,22 @@ class ClientConnection(object):
             self.worker.nb_connections +=1
             self.worker.refresh_name()
 
+        if self.cfg.preamble_timeout:
+            self.preamble_timer = self.worker.timers.add(
+                    self.cfg.preamble_timeout, self.expire_preamble,
+                    gevent.getcurrent())
+
         try:
             while not self.connected:
-                data = self.sock.recv(1024)
-                if not data:
+                if not self.preamble.recv(self.sock,
+                        self.cfg.preamble_read_size):
                     break
-                self.buf.append(data)
+
+                max_size = self.cfg.preamble_max_size
+                if max_size and len(self.preamble) > max_size:
+                    raise PreambleError("preamble larger than %s bytes" %
+                            max_size)
+
                 if self.remote is None:
                     try:
                         self.do_proxy()
@@ -56,6 +89,11 @@ class ClientConnection(object):
             self.handle_error(e)
         except InactivityTimeout, e:
             log.warn("inactivity timeout")
+            if self.remote is not None:
+                self.worker.health.failure(self.remote)
+            self.handle_error(e)
+        except PreambleError, e:
+            log.warn("closing connection: [%s]" % str(e))
             self.handle_error(e)
         except socket.error, e:
             log.error("socket.error: [%s]" % str(e))
@@ -67,6 +105,9 @@ class ClientConnection(object):
         except Exception, e:
             log.error("unknown error %s" % str(e))
         finally:
+            self.cancel_preamble_timer()
+            if self.backend is not None:
+                self.backend.release()
             if self.remote is not None:
                 log.debug("Close connection to %s:%s" % self.remote)
 
@@ -75,23 +116,69 @@ class ClientConnection(object):
                 self.worker.refresh_name()
             _closesocket(self.sock)
 
+    @property
+    def tls_hello(self):
+        """ the TLS ClientHello sent by the client or None if the data
+        received so far doesn't contain one """
+        if self._tls_hello is None:
+            try:
+                self._tls_hello = parse_client_hello(
+                        self.preamble.getvalue())
+            except ValueError:
+                pass
+        return self._tls_hello
+
     def handle_error(self, e):
         if hasattr(self.route, 'proxy_error'):
             self.route.proxy_error(self, e)
 
+    def expire_preamble(self, greenlet):
+        greenlet.kill(PreambleError("no route found after %ss" %
+            self.cfg.preamble_timeout), block=False)
+
+    def cancel_preamble_timer(self):
+        if self.preamble_timer is not None:
+            self.preamble_timer.cancel()
+            self.preamble_timer = None
+
     def do_proxy(self):
-        commands = self.route.proxy("".join(self.buf))
+        commands = None
+        if self.route.table is not None:
+            commands, final = self.lookup_table()
+            if not final: # wait for more data
+                return
+            if commands is None and not self.route.has_script:
+                raise StopIteration()
+
+        if commands is None:
+            if self.route.incremental:
+                chunk = self.preamble.view(self.fed)
+                self.fed = len(self.preamble)
+                commands = self.route.proxy_feed(chunk, self.state)
+            else:
+                commands = self.route.proxy(self.preamble.getvalue(),
+                        client=self)
+
         if commands is None: # do nothing
             return 
 
-        
+        self.cancel_preamble_timer()
         if not isinstance(commands, dict):
             raise StopIteration
+
+        if 'pool' in commands:
+            commands = self.select_backend(commands)
         
         if 'remote' in commands:
-            remote = parse_address(commands['remote'])
+            remote = commands['remote']
+            if isinstance(remote, list):
+                remote = map(parse_address, remote)
+            else:
+                remote = parse_address(remote)
             if 'data' in commands:
                 self.buf = [commands['data']]
+            else:
+                self.buf = [self.preamble.getvalue()]
             if 'reply' in commands:
                 self.send_data(self.sock, commands['reply'])
             
@@ -99,10 +186,13 @@ class ClientConnection(object):
             ssl_args = commands.get('ssl_args', {})
             extra = commands.get('extra')
             connect_timeout = commands.get('connect_timeout')
-            inactivity_timeout = commands.get('inactivity_timeout')
+            inactivity_timeout = commands.get('inactivity_timeout',
+                    self.route.cfg.inactivity_timeout)
+            keepalive = commands.get('keepalive', False)
+            stagger = commands.get('connect_stagger', CONNECT_STAGGER)
             self.connect_to_resource(remote, is_ssl=is_ssl, connect_timeout=connect_timeout,
                     inactivity_timeout=inactivity_timeout, extra=extra,
-                    **ssl_args)
+                    keepalive=keepalive, stagger=stagger, **ssl_args)
 
         elif 'close' in commands:
             if isinstance(commands['close'], basestring): 
@@ -110,25 +200,89 @@ class ClientConnection(object):
             raise StopIteration()
 
         elif 'file' in commands:
-            # command to send a file
-            if isinstance(commands['file'], basestring):
-                fdin = os.open(commands['file'], os.O_RDONLY)
-            else:
-                fdin = commands['file']
-
-            offset = commands.get('offset', 0)
-            nbytes = commands.get('nbytes', os.fstat(fdin).st_size)
-        
-            # send a reply if needed, useful in HTTP response.
-            if 'reply' in commands:
-                self.send_data(self.sock, commands['reply'])
-            
-            # use sendfile if possible to send the file content
-            async_sendfile(self.sock.fileno(), fdin, offset, nbytes)
+            self.send_file(commands)
             raise StopIteration()
         else:
             raise StopIteration()
 
+    def send_file(self, commands):
+        """ send the file of the file command. Paths are opened through
+        the worker file cache. A file descriptor given by the script is
+        closed once sent unless keep_fd is True. """
+        if isinstance(commands['file'], basestring):
+            f = self.worker.files.open(commands['file'])
+            fdin, size = f.fd, f.size
+        else:
+            f = None
+            fdin = commands['file']
+            size = None
+
+        try:
+            offset = commands.get('offset', 0)
+            nbytes = commands.get('nbytes')
+            if nbytes is None:
+                if size is None:
+                    size = os.fstat(fdin).st_size
+                nbytes = size
+
+            # send a reply if needed, useful in HTTP response. It's sent
+            # with the start of the file.
+            reply = commands.get('reply')
+            if reply is not None and not isinstance(reply, basestring):
+                with corked(self.sock):
+                    self.send_data(self.sock, reply)
+                    send_file(self.sock, fdin, offset, nbytes)
+            else:
+                # use sendfile if possible to send the file content
+                send_file(self.sock, fdin, offset, nbytes, header=reply)
+        finally:
+            if f is not None:
+                f.release()
+            elif not commands.get('keep_fd', False):
+                os.close(fdin)
+
+    def select_backend(self, commands):
+        """ replace the pool in `commands` by the remote selected by its
+        balancer """
+        try:
+            balancer = get_balancer(commands['pool'])
+        except KeyError:
+            raise ConnectionError("unknown pool: %r" % commands['pool'])
+
+        key = commands.get('hash_key')
+        if key is None and 'hash_by' in commands:
+            key = self.hash_key(commands['hash_by'])
+
+        try:
+            self.backend = balancer.select(key, health=self.worker.health)
+        except LookupError, e:
+            raise ConnectionError(str(e))
+        self.backend.acquire()
+
+        commands = dict(commands, remote=self.backend.addr)
+        del commands['pool']
+        return commands
+
+    def hash_key(self, name):
+        """ key used to select a server from a hash ring: the client
+        address, the TLS server name or the HTTP Host header """
+        if name == "client":
+            return self.addr[0]
+        elif name == "sni":
+            hello = self.tls_hello
+            return hello and hello.sni
+        elif name == "host":
+            return http_host(self.preamble.getvalue())[0]
+        raise ConnectionError("unknown hash key: %r" % name)
+
+    def lookup_table(self):
+        """ look for a route in the routing table """
+        table = self.route.table
+        port = None
+        if table.ports:
+            port = self.sock.getsockname()[1]
+        return table.match(self.preamble.getvalue(), port)
+
     def send_data(self, sock, data):
         if hasattr(data, 'read'):
             try:
@@ -137,34 +291,62 @@ class ClientConnection(object):
                 pass
             
             while True:
-                chunk = data.readline()
+                chunk = data.read(REPLY_READ_SIZE)
                 if not chunk:
                     break
                 sock.sendall(chunk)    
         elif isinstance(data, basestring):
            sock.sendall(data)
         else:
+            # iterables are sent in batches so generators still stream
+            batch = []
+            size = 0
             for chunk in data:
-                sock.sendall(chunk)
+                batch.append(chunk)
+                size += len(chunk)
+                if size >= REPLY_READ_SIZE or len(batch) >= IOV_MAX:
+                    sendall_chunks(sock, batch)
+                    batch = []
+                    size = 0
+            sendall_chunks(sock, batch)
 
     def connect_to_resource(self, addr, is_ssl=False, connect_timeout=None,
-            inactivity_timeout=None, extra=None, **ssl_args):
+            inactivity_timeout=None, extra=None, keepalive=False,
+            stagger=CONNECT_STAGGER, **ssl_args):
 
-        with gevent.Timeout(connect_timeout, ConnectionError):
-            try:
-                if is_ipv6(addr[0]):
-                    sock = socket.socket(socket.AF_INET6, 
-                            socket.SOCK_STREAM)
-                else:
-                    sock = socket.socket(socket.AF_INET, 
-                            socket.SOCK_STREAM)
+        if isinstance(addr, list):
+            addrs = self.worker.health.healthy(addr)
+        else:
+            addrs = [addr]
+
+        # only rewrite functions know where messages end
+        keepalive = keepalive and not self.route.empty_buf
 
-                if is_ssl:
-                    sock = ssl.wrap_socket(sock, **ssl_args)
-                sock.connect(addr)
-            except socket.error, e:
-                raise ConnectionError(
-                        "socket error while connectinng: [%s]" % str(e))
+        sock = None
+        if keepalive:
+            for addr in addrs:
+                sock = self.worker.upstreams.get(
+                        pool_key(addr, is_ssl, ssl_args))
+                if sock is not None:
+                    break
+
+        if sock is None:
+            started = time.time()
+            if len(addrs) == 1:
+                addr = addrs[0]
+                sock = self.open_connection(addr, is_ssl=is_ssl,
+                        connect_timeout=connect_timeout, **ssl_args)
+            else:
+                addr, sock = self.open_any(addrs, is_ssl=is_ssl,
+                        connect_timeout=connect_timeout, stagger=stagger,
+                        **ssl_args)
+
+            if self.backend is not None:
+                self.backend.observe(time.time() - started)
+
+        key = None
+        if keepalive:
+            key = pool_key(addr, is_ssl, ssl_args)
 
         self.remote = addr
         self.connected = True
@@ -175,9 +357,97 @@ class ClientConnection(object):
             self.buf = []
 
         server = ServerConnection(sock, self, 
-                timeout=inactivity_timeout, extra=extra, buf=self.buf)
+                timeout=inactivity_timeout, extra=extra, buf=self.buf,
+                pool_key=key, backend=self.backend)
         server.handle()
 
+    def open_connection(self, addr, is_ssl=False, connect_timeout=None,
+            **ssl_args):
+        """ connect to `addr`, trying each of its addresses in turn """
+        try:
+            with gevent.Timeout(connect_timeout, ConnectionError):
+                try:
+                    addresses = self.worker.resolver.resolve(addr)
+                except socket.error, e:
+                    raise ConnectionError(
+                            "socket error while connectinng: [%s]" % str(e))
+
+                error = "no address for %s:%s" % addr
+                for family, sockaddr in addresses:
+                    sock = socket.socket(family, socket.SOCK_STREAM)
+                    try:
+                        if is_ssl:
+                            sock = self.worker.ssl_contexts.wrap_socket(
+                                    sock, addr, **ssl_args)
+                        sock.connect(sockaddr)
+                    except socket.error, e:
+                        sock.close()
+                        error = str(e)
+                    else:
+                        break
+                else:
+                    raise ConnectionError(
+                            "socket error while connectinng: [%s]" % error)
+        except ConnectionError:
+            self.worker.health.failure(addr)
+            raise
+
+        self.worker.health.success(addr)
+        return sock
+
+    def open_any(self, addrs, is_ssl=False, connect_timeout=None,
+            stagger=CONNECT_STAGGER, **ssl_args):
+        """ connect to the first remote accepting the connection.
+
+        Remotes are tried in order. The next one is tried when the
+        previous attempt failed or didn't succeed after `stagger`
+        seconds, without cancelling it. The first connection
+        established is kept and the others are cancelled. """
+        results = Queue()
+        attempts = []
+        remaining = list(addrs)
+        failures = []
+        sock = None
+
+        def attempt(addr):
+            try:
+                sock = self.open_connection(addr, is_ssl=is_ssl, **ssl_args)
+            except ConnectionError, e:
+                results.put((addr, None, e))
+            else:
+                results.put((addr, sock, None))
+
+        try:
+            with gevent.Timeout(connect_timeout, ConnectionError):
+                while True:
+                    timeout = None
+                    if remaining:
+                        attempts.append(gevent.spawn(attempt,
+                            remaining.pop(0)))
+                        if remaining:
+                            timeout = stagger
+
+                    try:
+                        addr, sock, error = results.get(timeout=timeout)
+                    except Empty:
+                        continue
+
+                    if sock is not None:
+                        return addr, sock
+
+                    log.debug("error while connecting to %s:%s" % addr)
+                    failures.append(error)
+                    if len(failures) == len(addrs):
+                        raise ConnectionError("all remotes failed: [%s]" %
+                                ", ".join(map(str, failures)))
+        finally:
+            gevent.killall(attempts, block=True)
+            # close connections established after the winner
+            while not results.empty():
+                late = results.get()[1]
+                if late is not None and late is not sock:
+                    late.close()
+
 def _closesocket(sock):
     try:
         sock._sock.close()
@@ -24,6 +24,9 @@ import types
 from . import __version__
 from . import util
 
+# minimum interval between two rotations of the ssl ticket keys
+MIN_TICKET_ROTATE = 300
+
 KNOWN_SETTINGS = []
 
 class ConfigError(Exception):
@@ -98,6 +101,12 @@ class Config(object):
     def gid(self):
         return self.settings['group'].get()
         
+    @property
+    def drain_timeout(self):
+        """ seconds workers wait for their connections to close on QUIT,
+        None to wait as long as necessary """
+        return self.settings['graceful_timeout'].get() or None
+
     @property
     def name(self):
         pn = self.settings['name'].get()
@@ -193,6 +202,13 @@ def validate_pos_int(val):
         raise ValueError("Value must be positive: %s" % val)
     return val
 
+def validate_ticket_rotate(val):
+    val = validate_pos_int(val)
+    if 0 < val < MIN_TICKET_ROTATE:
+        raise ValueError("ssl_ticket_rotate must be 0 or at least %ss" %
+                MIN_TICKET_ROTATE)
+    return val
+
 def validate_string(val):
     if val is None:
         return None
@@ -200,6 +216,22 @@ def validate_string(val):
         raise TypeError("Not a string: %s" % val)
     return val.strip()
 
+def validate_list_string(val):
+    if not val:
+        return []
+
+    # legacy syntax
+    if isinstance(val, basestring):
+        val = [val]
+
+    return [validate_string(v) for v in val]
+
+def validate_relay(val):
+    val = validate_string(val)
+    if val not in ("greenlets", "single"):
+        raise ValueError("Invalid relay engine: %s" % val)
+    return val
+
 def validate_callable(arity):
     def _validate_callable(val):
         if not callable(val):
@@ -298,6 +330,154 @@ class WorkerConnections(Setting):
         The maximum number of simultaneous clients per worker.
         """
 
+class BufferSize(Setting):
+    name = "buffer_size"
+    section = "Worker Processes"
+    cli = ["--buffer-size"]
+    meta = "INT"
+    validator = validate_pos_int
+    type = "int"
+    default = 8192
+    desc = """\
+        Size in bytes of the relay buffers, at most 2 x worker_connections.
+
+        Each connection uses a buffer per direction, buffers are reused
+        between connections. A new one is only allocated when none is
+        free, so a worker holds at most 2 x worker_connections x
+        buffer_size bytes of buffers.
+        """
+
+class Relay(Setting):
+    name = "relay"
+    section = "Worker Processes"
+    cli = ["--relay"]
+    meta = "STRING"
+    validator = validate_relay
+    default = "greenlets"
+    desc = """\
+        The engine used to relay data between the client and the remote.
+
+        * greenlets - one greenlet per direction. splice(2) is used when
+          available.
+        * single - both directions are relayed from one greenlet driven
+          by io watchers. Requires gevent >= 1.0.
+
+        Connections over ssl or rewritten by the script are always relayed
+        by greenlets.
+        """
+
+class PreambleReadSize(Setting):
+    name = "preamble_read_size"
+    section = "Worker Processes"
+    cli = ["--preamble-read-size"]
+    meta = "INT"
+    validator = validate_pos_int
+    type = "int"
+    default = 4096
+    desc = """\
+        The maximum number of bytes read at once from a client until the
+        script returns a route.
+        """
+
+class PreambleMaxSize(Setting):
+    name = "preamble_max_size"
+    section = "Worker Processes"
+    cli = ["--preamble-max-size"]
+    meta = "INT"
+    validator = validate_pos_int
+    type = "int"
+    default = 65536
+    desc = """\
+        Close a connection when the script didn't return a route after
+        this many bytes.
+
+        0 means no limit.
+        """
+
+class PreambleTimeout(Setting):
+    name = "preamble_timeout"
+    section = "Worker Processes"
+    cli = ["--preamble-timeout"]
+    meta = "INT"
+    validator = validate_pos_int
+    type = "int"
+    default = 30
+    desc = """\
+        Close a connection when the script didn't return a route after
+        this many seconds.
+
+        0 means no limit.
+        """
+
+class InactivityTimeout(Setting):
+    name = "inactivity_timeout"
+    section = "Worker Processes"
+    cli = ["--inactivity-timeout"]
+    meta = "INT"
+    validator = validate_pos_int
+    type = "int"
+    default = 0
+    desc = """\
+        Close a proxied connection after this many seconds without data.
+
+        This is the default value of the inactivity_timeout command
+        returned by the script. 0 means connections never time out.
+        """
+
+class UpstreamKeepalive(Setting):
+    name = "upstream_keepalive"
+    section = "Worker Processes"
+    cli = ["--upstream-keepalive"]
+    meta = "INT"
+    validator = validate_pos_int
+    type = "int"
+    default = 10
+    desc = """\
+        The maximum number of idle connections kept per remote address.
+
+        Connections are only kept when the script returns the keepalive
+        command and its rewrite functions mark the end of each message.
+        0 disables the pool.
+        """
+
+class UpstreamIdleTimeout(Setting):
+    name = "upstream_idle_timeout"
+    section = "Worker Processes"
+    cli = ["--upstream-idle-timeout"]
+    meta = "INT"
+    validator = validate_pos_int
+    type = "int"
+    default = 30
+    desc = """\
+        Close idle remote connections kept in the pool after this many
+        seconds.
+        """
+
+class FileCacheSize(Setting):
+    name = "file_cache_size"
+    section = "Worker Processes"
+    cli = ["--file-cache-size"]
+    meta = "INT"
+    validator = validate_pos_int
+    type = "int"
+    default = 256
+    desc = """\
+        The maximum number of files sent with the file command kept open
+        by each worker. 0 opens the file for each response.
+        """
+
+class FileCacheRevalidate(Setting):
+    name = "file_cache_revalidate"
+    section = "Worker Processes"
+    cli = ["--file-cache-revalidate"]
+    meta = "INT"
+    validator = validate_pos_int
+    type = "int"
+    default = 5
+    desc = """\
+        Check that an open file didn't change after this many seconds.
+        """
+
 class Timeout(Setting):
     name = "timeout"
     section = "Worker Processes"
@@ -315,6 +495,21 @@ class Timeout(Setting):
         is not tied to the length of time required to handle a single request.
         """
 
+class GracefulTimeout(Setting):
+    name = "graceful_timeout"
+    section = "Worker Processes"
+    cli = ["--graceful-timeout"]
+    meta = "INT"
+    validator = validate_pos_int
+    type = "int"
+    default = 0
+    desc = """\
+        Workers stopped gracefully, on QUIT or HUP, close the connections
+        still open after this many seconds.
+
+        0 waits as long as necessary.
+        """
+
 class Daemon(Setting):
     name = "daemon"
     section = "Server Mechanics"
@@ -454,6 +649,183 @@ class Procname(Setting):
         It defaults to 'tproxy'.
         """
 
+class Routes(Setting):
+    name = "routes"
+    section = "Routing"
+    cli = ["--routes"]
+    meta = "FILE"
+    validator = validate_string
+    default = None
+    desc = """\
+        A file of routing rules looked up before calling the script.
+
+        Each line is a rule ``kind pattern remote [key=value ...]`` where
+        kind is one of port, sni, host, prefix or default. Connections that
+        don't match any rule are routed by the script. With a routing
+        file, the script is optional.
+        """
+
+class RouteCacheSize(Setting):
+    name = "route_cache_size"
+    section = "Routing"
+    cli = ["--route-cache-size"]
+    meta = "INT"
+    validator = validate_pos_int
+    type = "int"
+    default = 1024
+    desc = """\
+        The maximum number of decisions of the script kept by each worker.
+
+        Decisions are only cached when the script defines proxy_key.
+        0 disables the cache.
+        """
+
+class RouteCacheTtl(Setting):
+    name = "route_cache_ttl"
+    section = "Routing"
+    cli = ["--route-cache-ttl"]
+    meta = "INT"
+    validator = validate_pos_int
+    type = "int"
+    default = 60
+    desc = """\
+        Call the script again for a key after this many seconds. With 0,
+        decisions are kept until they are dropped from the cache.
+        """
+
+class DnsTtl(Setting):
+    name = "dns_ttl"
+    section = "DNS"
+    cli = ["--dns-ttl"]
+    meta = "INT"
+    validator = validate_pos_int
+    type = "int"
+    default = 60
+    desc = """\
+        Cache the addresses of remote host names for this many seconds.
+
+        Each worker keeps its own cache. 0 disables the cache.
+        """
+
+class DnsNegativeTtl(Setting):
+    name = "dns_negative_ttl"
+    section = "DNS"
+    cli = ["--dns-negative-ttl"]
+    meta = "INT"
+    validator = validate_pos_int
+    type = "int"
+    default = 5
+    desc = """\
+        Cache resolution errors for this many seconds.
+        """
+
+class DnsStaleTtl(Setting):
+    name = "dns_stale_ttl"
+    section = "DNS"
+    cli = ["--dns-stale-ttl"]
+    meta = "INT"
+    validator = validate_pos_int
+    type = "int"
+    default = 300
+    desc = """\
+        Keep using expired addresses for this many seconds while they
+        are resolved again in the background, or when it fails.
+        """
+
+class DnsCacheSize(Setting):
+    name = "dns_cache_size"
+    section = "DNS"
+    cli = ["--dns-cache-size"]
+    meta = "INT"
+    validator = validate_pos_int
+    type = "int"
+    default = 1024
+    desc = """\
+        The maximum number of host names in the cache.
+        """
+
+class HealthMaxFailures(Setting):
+    name = "health_max_failures"
+    section = "Health Checks"
+    cli = ["--health-max-failures"]
+    meta = "INT"
+    validator = validate_pos_int
+    type = "int"
+    default = 5
+    desc = """\
+        Eject a remote after this many consecutive failures.
+
+        Connection errors, inactivity timeouts and failed health checks
+        count as failures. Ejected remotes are skipped when a pool or a
+        list of remotes is used. 0 disables ejection.
+        """
+
+class HealthEjectionTime(Setting):
+    name = "health_ejection_time"
+    section = "Health Checks"
+    cli = ["--health-ejection-time"]
+    meta = "INT"
+    validator = validate_pos_int
+    type = "int"
+    default = 30
+    desc = """\
+        The number of seconds a remote is ejected for.
+
+        The time is multiplied by the number of times the remote has
+        been ejected in a row, up to 10 times.
+        """
+
+class HealthCheckInterval(Setting):
+    name = "health_check_interval"
+    section = "Health Checks"
+    cli = ["--health-check-interval"]
+    meta = "INT"
+    validator = validate_pos_int
+    type = "int"
+    default = 0
+    desc = """\
+        Check the remotes of the pools every this many seconds.
+
+        A check connects to the remote, sends health_check_send and reads
+        the response. 0 disables the checks.
+        """
+
+class HealthCheckTimeout(Setting):
+    name = "health_check_timeout"
+    section = "Health Checks"
+    cli = ["--health-check-timeout"]
+    meta = "INT"
+    validator = validate_pos_int
+    type = "int"
+    default = 2
+    desc = """\
+        A health check fails if it takes more than this many seconds.
+        """
+
+class HealthCheckSend(Setting):
+    name = "health_check_send"
+    section = "Health Checks"
+    cli = ["--health-check-send"]
+    meta = "STRING"
+    validator = validate_string
+    default = None
+    desc = """\
+        Data sent by a health check once connected. Python string escapes
+        can be used, eg. "HEAD / HTTP/1.0\\r\\n\\r\\n".
+        """
+
+class HealthCheckExpect(Setting):
+    name = "health_check_expect"
+    section = "Health Checks"
+    cli = ["--health-check-expect"]
+    meta = "STRING"
+    validator = validate_string
+    default = None
+    desc = """\
+        The start of the response expected by a health check, eg.
+        "HTTP/1.1 200". By default a connection is enough.
+        """
+
 class SslKeyFile(Setting):
     name = "ssl_keyfile"
     section = "Ssl"
@@ -515,3 +887,81 @@ class SSLCertReq(Setting):
         validated).
         """
 
+class SslSniCerts(Setting):
+    name = "ssl_sni_certs"
+    section = "Ssl"
+    cli = ["--ssl-sni-cert"]
+    action = "append"
+    validator = validate_list_string
+    meta = "NAME=CERTFILE[,KEYFILE]"
+    default = []
+    desc = """\
+        A certificate used when the client asks for this server name.
+
+        Can be given several times. The name can be a wildcard like
+        *.example.com. Other clients get the ssl_certfile certificate.
+        """
+
+class SslTicketRotate(Setting):
+    name = "ssl_ticket_rotate"
+    section = "Ssl"
+    cli = ["--ssl-ticket-rotate"]
+    validator = validate_ticket_rotate
+    meta = "INT"
+    type = "int"
+    default = 0
+    desc = """\
+        Rotate the TLS session ticket keys every this many seconds.
+
+        Keys are created by the master and shared by the workers so
+        clients can resume their sessions with any of them. They are
+        rotated by gracefully restarting the workers, like on HUP: the
+        per-worker caches, connection pools and balancer counters start
+        empty and old workers keep serving their connections until they
+        close, or for graceful_timeout seconds if it's set. With long
+        lived connections and no graceful_timeout, old workers can pile
+        up between rotations. The interval must be at least 300 seconds.
+        0 disables the rotation.
+        """
+
+class SslHandshakeThreads(Setting):
+    name = "ssl_handshake_threads"
+    section = "Ssl"
+    cli = ["--ssl-handshake-threads"]
+    validator = validate_pos_int
+    meta = "INT"
+    type = "int"
+    default = 0
+    desc = """\
+        Run the ssl handshakes of the clients in this many threads.
+
+        Established connections keep being relayed during the
+        handshakes. Requires gevent 1.0. 0 runs the handshakes in the
+        worker loop.
+        """
+
+class SslHandshakeMax(Setting):
+    name = "ssl_handshake_max"
+    section = "Ssl"
+    cli = ["--ssl-handshake-max"]
+    validator = validate_pos_int
+    meta = "INT"
+    type = "int"
+    default = 100
+    desc = """\
+        The maximum number of ssl handshakes running in threads at the
+        same time in a worker. Others wait for their turn.
+        """
+
+class SslHandshakeTimeout(Setting):
+    name = "ssl_handshake_timeout"
+    section = "Ssl"
+    cli = ["--ssl-handshake-timeout"]
+    validator = validate_pos_int
+    meta = "INT"
+    type = "int"
+    default = 10
+    desc = """\
+        Close client connections not done with their ssl handshake
+        after this many seconds, waiting included.
+        """
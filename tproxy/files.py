@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -
+#
+# This file is part of tproxy released under the MIT license.
+# See the NOTICE for more information.
+
+import os
+import time
+
+from .cache import LRUCache
+
+
+class OpenFile(object):
+    """ a file descriptor shared by the responses sending the file. It's
+    closed once it has been dropped from the cache and released by all
+    of them. """
+
+    __slots__ = ('path', 'fd', 'size', 'mtime', 'ino', 'checked', 'refs',
+            'cached')
+
+    def __init__(self, path, fd, st):
+        self.path = path
+        self.fd = fd
+        self.size = st.st_size
+        self.mtime = st.st_mtime
+        self.ino = st.st_ino
+        self.checked = time.time()
+        self.refs = 0
+        self.cached = True
+
+    def __repr__(self):
+        return "<OpenFile %s fd=%s refs=%s>" % (self.path, self.fd,
+                self.refs)
+
+    def is_current(self, st):
+        return (st.st_size, st.st_mtime, st.st_ino) == (self.size,
+                self.mtime, self.ino)
+
+    def acquire(self):
+        self.refs += 1
+        return self
+
+    def release(self):
+        self.refs -= 1
+        if not self.refs and not self.cached:
+            self.close()
+
+    def uncache(self):
+        self.cached = False
+        if not self.refs:
+            self.close()
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class FileCache(object):
+    """ per-worker LRU of open files sent with the file command.
+
+    A cached file is checked again with stat after `revalidate`
+    seconds and reopened if it changed. Opening a file doesn't yield to
+    the hub so concurrent responses for the same path share one
+    descriptor. At most `maxsize` files are kept open. """
+
+    def __init__(self, maxsize=256, revalidate=5):
+        self.revalidate = revalidate
+        self.files = LRUCache(maxsize, on_evict=self.evict)
+
+    def open(self, path):
+        """ return the acquired OpenFile of `path`. It must be released
+        once sent. """
+        f = self.files.get(path)
+        if f is not None:
+            now = time.time()
+            if now - f.checked < self.revalidate:
+                return f.acquire()
+
+            try:
+                st = os.stat(path)
+            except OSError:
+                st = None
+            if st is not None and f.is_current(st):
+                f.checked = now
+                return f.acquire()
+
+            # the file changed
+            self.files.pop(path)
+            f.uncache()
+
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            f = OpenFile(path, fd, os.fstat(fd))
+        except OSError:
+            os.close(fd)
+            raise
+
+        self.files.set(path, f)
+        if path not in self.files:
+            # caching is disabled
+            f.cached = False
+        return f.acquire()
+
+    def evict(self, path, f):
+        f.uncache()
+
+    def close(self):
+        for path in list(self.files.items):
+            self.files.pop(path).uncache()
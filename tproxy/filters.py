@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -
+#
+# This file is part of tproxy released under the MIT license.
+# See the NOTICE for more information.
+
+""" filter pipelines for rewrite functions.
+
+A stage is a function taking an iterator of chunks, and the RewriteIO
+if it accepts a second argument, and returning an iterator of the chunks
+to send, usually a generator::
+
+    def upper(chunks):
+        for chunk in chunks:
+            if chunk is MESSAGE_END:
+                yield chunk
+            else:
+                yield tobytes(chunk).upper()
+
+    rewrite_response = Pipeline(http_headers(rules), upper,
+            count_bytes(log_size))
+
+Stages run in the greenlet relaying the data, each one pulling the
+chunks it needs from the previous one. Read chunks are memoryviews only
+valid until the next one is asked for, stages keeping data must copy
+it. Stages may yield strings or buffers.
+
+After each HTTP message kept alive, `http_headers` yields `MESSAGE_END`
+instead of a chunk. Stages must send the data they hold back before
+passing it on, the pipeline ends the message on the pipe once
+everything before it has been written. """
+
+from collections import deque
+import re
+import socket
+
+from .http import REQUEST, HttpParser
+from .util import arity
+
+READ_SIZE = 8192
+
+# yielded between two HTTP messages, see the module documentation
+MESSAGE_END = object()
+
+
+def tobytes(chunk):
+    """ copy of a chunk as a string """
+    if isinstance(chunk, memoryview):
+        return chunk.tobytes()
+    return bytes(chunk)
+
+
+class Pipeline(object):
+    """ rewrite function sending the data read through `stages` """
+
+    def __init__(self, *stages, **kwargs):
+        self.read_size = kwargs.get("read_size", READ_SIZE)
+        # the arguments of the stages are only looked up once
+        self.stages = [(stage, arity(stage) > 1) for stage in stages]
+
+    def __call__(self, pipe):
+        chunks = read_chunks(pipe, self.read_size)
+        for stage, with_pipe in self.stages:
+            if with_pipe:
+                chunks = stage(chunks, pipe)
+            else:
+                chunks = stage(chunks)
+
+        write = pipe.write
+        try:
+            for chunk in chunks:
+                if chunk is MESSAGE_END:
+                    pipe.end_message()
+                else:
+                    write(chunk)
+        except socket.error:
+            pass
+
+
+def read_chunks(pipe, size=READ_SIZE):
+    """ yield the data read from `pipe` in a reused buffer """
+    view = memoryview(bytearray(size))
+    while True:
+        recved = pipe.readinto(view)
+        if not recved:
+            break
+        yield view[:recved]
+
+
+class ChunkReader(object):
+    """ readinto over an iterator of chunks, so stages can use code
+    reading from a pipe. `MESSAGE_END` markers are skipped. """
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.pending = None
+
+    def readinto(self, b):
+        while not self.pending:
+            try:
+                chunk = next(self.chunks)
+            except StopIteration:
+                return 0
+            if chunk is not MESSAGE_END:
+                self.pending = memoryview(chunk)
+
+        size = min(len(b), len(self.pending))
+        b[:size] = self.pending[:size]
+        self.pending = self.pending[size:]
+        return size
+
+
+def count_bytes(callback):
+    """ stage counting the bytes passing through it. `callback` is
+    called with the total when the stream ends """
+    def stage(chunks):
+        total = 0
+        try:
+            for chunk in chunks:
+                if chunk is not MESSAGE_END:
+                    total += len(chunk)
+                yield chunk
+        finally:
+            callback(total)
+    return stage
+
+
+def http_headers(rewrite, kind=REQUEST):
+    """ stage relaying HTTP messages with `rewrite` applied to their
+    header blocks, see `tproxy.http.relay_messages`. `MESSAGE_END` is
+    yielded after each message kept alive. """
+    def stage(chunks, pipe):
+        parser = HttpParser(pipe, kind, source=ChunkReader(chunks))
+        return parser.messages(rewrite, end=MESSAGE_END)
+    return stage
+
+
+class Automaton(object):
+    """ Aho-Corasick automaton finding a set of literal patterns in one
+    pass whatever their number.
+
+    States are numbered, `goto` holds their transitions, `fail` the
+    state of their longest proper suffix that is also a prefix of a
+    pattern and `output` the longest pattern ending there. """
+
+    def __init__(self, patterns):
+        self.goto = [{}]
+        self.fail = [0]
+        self.depth = [0]
+        self.output = [None]
+        for pattern in patterns:
+            if not pattern:
+                raise ValueError("can't match an empty pattern")
+            self.add(pattern)
+        self.build()
+
+    def add(self, pattern):
+        state = 0
+        for char in pattern:
+            nxt = self.goto[state].get(char)
+            if nxt is None:
+                nxt = len(self.goto)
+                self.goto.append({})
+                self.fail.append(0)
+                self.depth.append(self.depth[state] + 1)
+                self.output.append(None)
+                self.goto[state][char] = nxt
+            state = nxt
+        self.output[state] = pattern
+
+    def build(self):
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, nxt in self.goto[state].items():
+                queue.append(nxt)
+                self.fail[nxt] = self.step(self.fail[state], char) \
+                        if state else 0
+                if self.output[nxt] is None:
+                    self.output[nxt] = self.output[self.fail[nxt]]
+
+        # only the first byte of a pattern leaves the root
+        self.first = re.compile("[%s]" % "".join(re.escape(char)
+            for char in self.goto[0]))
+
+    def step(self, state, char):
+        goto = self.goto
+        fail = self.fail
+        while True:
+            nxt = goto[state].get(char)
+            if nxt is not None:
+                return nxt
+            if not state:
+                return 0
+            state = fail[state]
+
+
+def replace(old, new=None):
+    """ stage replacing the literal `old` by `new`, or each key of the
+    dict `old` by its value.
+
+    All the patterns are searched in one pass, also across chunks: only
+    the bytes that may start a match are kept between two chunks, other
+    data is sent as slices of the chunks. When matches overlap, the one
+    ending first is replaced, the longest if several end there. Matches
+    don't span two HTTP messages.
+
+    Lengths announced in the data aren't updated: after `http_headers`
+    the replacements must have the length of their pattern, otherwise
+    Content-Length and chunk sizes go wrong. """
+    if isinstance(old, dict):
+        patterns = old
+    else:
+        patterns = {old: new}
+    automaton = Automaton(patterns)
+    first = automaton.first
+    step = automaton.step
+    output = automaton.output
+    depth = automaton.depth
+
+    def stage(chunks):
+        tail = ""
+        state = 0
+        for chunk in chunks:
+            if chunk is MESSAGE_END:
+                if tail:
+                    yield tail
+                tail = ""
+                state = 0
+                yield chunk
+                continue
+
+            view = memoryview(chunk)
+            # the chunk is only copied to be scanned
+            text = tobytes(chunk)
+            size = len(text)
+
+            # offsets are relative to the chunk, the tail is before it
+            sent = -len(tail)
+            pos = 0
+            while pos < size:
+                if not state:
+                    match = first.search(text, pos)
+                    if match is None:
+                        break
+                    pos = match.start()
+                state = step(state, text[pos])
+                pos += 1
+                pattern = output[state]
+                if pattern is not None:
+                    for data in _span(tail, view, sent, pos - len(pattern)):
+                        yield data
+                    yield patterns[pattern]
+                    sent = pos
+                    state = 0
+
+            # the bytes matched so far are kept for the next chunk
+            cut = size - depth[state]
+            for data in _span(tail, view, sent, cut):
+                yield data
+            tail = "".join(tobytes(data) for data in
+                    _span(tail, view, max(sent, cut), size))
+        if tail:
+            yield tail
+    return stage
+
+
+def _span(tail, view, start, end):
+    """ data between two offsets relative to `view`, negative ones are
+    in `tail` """
+    if start < 0 and start < end:
+        yield tail[len(tail) + start:len(tail) + min(end, 0)]
+    if end > 0 and max(start, 0) < end:
+        yield view[max(start, 0):end]
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -
+#
+# This file is part of tproxy released under the MIT license.
+# See the NOTICE for more information.
+
+import hashlib
+import logging
+import mmap
+import struct
+import time
+
+import gevent
+from gevent import socket
+
+from .util import is_ipv6
+
+log = logging.getLogger(__name__)
+
+# ejected until, last check, consecutive failures, ejections
+_slot = struct.Struct("<ddII")
+
+# max multiplier of the ejection time for a host ejected repeatedly
+MAX_EJECTIONS = 10
+
+# number of slots a host can be stored in, read at once
+MAX_PROBES = 16
+_keys = struct.Struct("<%dQ" % MAX_PROBES)
+
+
+def _key(addr):
+    digest = hashlib.md5("%s:%s" % tuple(addr)).digest()
+    # 0 marks a free slot
+    return struct.unpack_from("<Q", digest)[0] or 1
+
+
+class HealthTable(object):
+    """ health of remote hosts.
+
+    The state of each host is kept in a fixed size table in an
+    anonymous shared mmap. The arbiter creates it before forking so all
+    workers see the same ejections. Updates aren't locked: workers may
+    lose a failure count when they race, which only delays an ejection.
+
+    A host is ejected for `ejection_time` seconds after `max_failures`
+    consecutive failures. The ejection time grows each time the host is
+    ejected again without a success in between.
+
+    A host can only be stored in the MAX_PROBES slots following its
+    hash, their keys are read at once. When they are all used, the slot
+    of a host without failures or whose ejection expired is reused.
+    The number of hosts stored from each slot is counted so hosts never
+    tracked are known without reading the keys. """
+
+    def __init__(self, size=4096, max_failures=5, ejection_time=30):
+        self.size = max(size, MAX_PROBES)
+        self.max_failures = max_failures
+        self.ejection_time = ejection_time
+        # counts, keys, then slots
+        self.keys_offset = self.size
+        self.slots_offset = self.keys_offset + self.size * 8
+        self.mem = mmap.mmap(-1, self.slots_offset +
+                self.size * _slot.size)
+
+    def _home(self, key):
+        # windows of slots never wrap around
+        return key % (self.size - MAX_PROBES + 1)
+
+    def lookup(self, addr, create=False):
+        """ return the index of the slot of `addr` or None """
+        key = _key(addr)
+        home = self._home(key)
+        if not create and self.mem[home] == "\0":
+            return None
+
+        keys = _keys.unpack_from(self.mem, self.keys_offset + home * 8)
+        try:
+            return home + keys.index(key)
+        except ValueError:
+            if not create:
+                return None
+
+        index = self._reusable(home, keys)
+        if index is None:
+            log.warn("health table full, %s:%s isn't tracked" % addr)
+            return None
+
+        old_key = keys[index - home]
+        if old_key:
+            old_home = self._home(old_key)
+            self.mem[old_home] = chr(max(ord(self.mem[old_home]) - 1, 0))
+        self.mem[home] = chr(min(ord(self.mem[home]) + 1, 255))
+        struct.pack_into("<Q", self.mem, self.keys_offset + index * 8, key)
+        self._write(index, 0, 0, 0, 0)
+        return index
+
+    def _reusable(self, home, keys):
+        if 0 in keys:
+            return home + keys.index(0)
+        now = time.time()
+        for i in xrange(MAX_PROBES):
+            until, _, failures, _ = self._read(home + i)
+            if until <= now and (until or not failures):
+                return home + i
+        return None
+
+    def _read(self, index):
+        return _slot.unpack_from(self.mem,
+                self.slots_offset + index * _slot.size)
+
+    def _write(self, index, *values):
+        _slot.pack_into(self.mem, self.slots_offset + index * _slot.size,
+                *values)
+
+    def get(self, addr):
+        """ return (ejected until, last check, failures, ejections) """
+        index = self.lookup(addr)
+        if index is None:
+            return 0, 0, 0, 0
+        return self._read(index)
+
+    def is_ejected(self, addr, now=None):
+        return self.get(addr)[0] > (now or time.time())
+
+    def success(self, addr):
+        index = self.lookup(addr)
+        if index is None:
+            return
+        _, checked, failures, ejections = self._read(index)
+        if failures or ejections:
+            self._write(index, 0, checked, 0, 0)
+
+    def failure(self, addr):
+        if not self.max_failures:
+            return
+
+        index = self.lookup(addr, create=True)
+        if index is None:
+            return
+
+        now = time.time()
+        until, checked, failures, ejections = self._read(index)
+        if until > now:
+            # already ejected
+            return
+
+        failures += 1
+        if failures >= self.max_failures:
+            ejections = min(ejections + 1, MAX_EJECTIONS)
+            until = now + self.ejection_time * ejections
+            failures = 0
+            log.warn("ejecting %s:%s for %ss" % (addr[0], addr[1],
+                until - now))
+        self._write(index, until, checked, failures, ejections)
+
+    def checked(self, addr, interval):
+        """ mark `addr` as checked now. Return False if another worker
+        checked it less than `interval` seconds ago. """
+        index = self.lookup(addr, create=True)
+        if index is None:
+            return True
+
+        now = time.time()
+        until, checked, failures, ejections = self._read(index)
+        if now - checked < interval:
+            return False
+        self._write(index, until, now, failures, ejections)
+        return True
+
+    def healthy(self, addrs):
+        """ remove ejected hosts from `addrs`. All hosts are returned if
+        they are all ejected. """
+        now = time.time()
+        healthy = [addr for addr in addrs if not self.is_ejected(addr, now)]
+        return healthy or addrs
+
+
+class HealthChecker(object):
+    """ probe remote hosts every `interval` seconds from a greenlet.
+
+    A probe connects to the host, sends `send` if given and reads the
+    response, which should start with `expect` if given. """
+
+    def __init__(self, health, hosts, interval, timeout=2, send=None,
+            expect=None):
+        self.health = health
+        self.hosts = hosts
+        self.interval = interval
+        self.timeout = timeout
+        self.send = send
+        self.expect = expect
+        self._greenlet = None
+
+    def start(self):
+        if self._greenlet is None:
+            self._greenlet = gevent.spawn(self.run)
+
+    def stop(self):
+        if self._greenlet is not None:
+            self._greenlet.kill(block=False)
+            self._greenlet = None
+
+    def run(self):
+        while True:
+            for addr in self.hosts():
+                # only one worker checks a host in each interval
+                if self.health.checked(addr, self.interval):
+                    gevent.spawn(self.check, addr)
+            gevent.sleep(self.interval)
+
+    def check(self, addr):
+        if self.probe(addr):
+            self.health.success(addr)
+        else:
+            self.health.failure(addr)
+
+    def probe(self, addr):
+        if is_ipv6(addr[0]):
+            sock = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+        else:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+
+        try:
+            with gevent.Timeout(self.timeout, False):
+                sock.connect(addr)
+                if self.send:
+                    sock.sendall(self.send)
+                if not self.expect:
+                    return True
+
+                data = ""
+                while len(data) < len(self.expect):
+                    chunk = sock.recv(1024)
+                    if not chunk:
+                        break
+                    data += chunk
+                return data.startswith(self.expect)
+        except socket.error, e:
+            log.debug("health check of %s:%s failed: %s" % (addr[0],
+                addr[1], str(e)))
+            return False
+        finally:
+            sock.close()
+        return False
@@ -0,0 +1,485 @@
+# -*- coding: utf-8 -
+#
+# This file is part of tproxy released under the MIT license.
+# See the NOTICE for more information.
+
+""" streaming HTTP/1.x parser for rewrite functions.
+
+Only the header block of each message is parsed, it's sent as received
+unless it has been changed. Bodies are forwarded as slices of the
+receive buffer, following their content length or their chunks so
+keep-alive connections can be relayed message per message. """
+
+import logging
+import socket
+
+log = logging.getLogger(__name__)
+
+REQUEST = "request"
+RESPONSE = "response"
+
+BUFFER_SIZE = 8192
+MAX_HEADER_SIZE = 65536
+
+
+class HttpError(Exception):
+    """ Exception raised on an invalid or incomplete HTTP message """
+
+
+class HttpMessage(object):
+    """ start line and headers of a request or a response.
+
+    `headers` is a list of [name, value] in the received order. The
+    header block is only rebuilt when the start line or the headers have
+    been changed. """
+
+    def __init__(self, kind, raw, start_line, headers):
+        self.kind = kind
+        self.raw = raw
+        self.headers = headers
+        self.method = self.url = self.status = self.reason = None
+        if kind == REQUEST:
+            self.method, self.url, self.version = start_line
+        else:
+            self.version, self.status, self.reason = start_line
+        self._start_line = start_line
+        self.modified = False
+
+        # set by the parser
+        self.chunked = False
+        self.length = 0
+        self.keep_alive = False
+        self.interim = False
+
+    def start_line(self):
+        if self.kind == REQUEST:
+            return (self.method, self.url, self.version)
+        return (self.version, self.status, self.reason)
+
+    def get(self, name, default=None):
+        name = name.lower()
+        for hname, value in self.headers:
+            if hname.lower() == name:
+                return value
+        return default
+
+    def tokens(self, name):
+        """ lowercased comma separated values of all `name` headers """
+        name = name.lower()
+        tokens = []
+        for hname, value in self.headers:
+            if hname.lower() == name:
+                tokens.extend(t.strip().lower() for t in value.split(","))
+        return [t for t in tokens if t]
+
+    def add(self, name, value):
+        self.headers.append([name, value])
+        self.modified = True
+
+    def remove(self, name):
+        name = name.lower()
+        headers = [h for h in self.headers if h[0].lower() != name]
+        if len(headers) != len(self.headers):
+            self.headers = headers
+            self.modified = True
+
+    def set(self, name, value):
+        """ replace all `name` headers by a single one, in place of the
+        first one """
+        lname = name.lower()
+        for i, header in enumerate(self.headers):
+            if header[0].lower() == lname:
+                self.remove(name)
+                self.headers.insert(i, [name, value])
+                self.modified = True
+                return
+        self.add(name, value)
+
+    def header_block(self):
+        if not self.modified and self.start_line() == self._start_line:
+            return self.raw
+
+        if self.kind == REQUEST:
+            lines = ["%s %s HTTP/%d.%d\r\n" % ((self.method, self.url) +
+                self.version)]
+        else:
+            lines = ["HTTP/%d.%d %d %s\r\n" % (self.version +
+                (self.status, self.reason))]
+        lines.extend("%s: %s\r\n" % (name, value)
+                for name, value in self.headers)
+        lines.append("\r\n")
+        return "".join(lines)
+
+
+class HeaderRules(object):
+    """ header rewrite rules applied in order to each message.
+
+    Values can be callables, they are called with the message::
+
+        rules = HeaderRules().set("Host", "gunicorn.org").remove("Via")
+    """
+
+    def __init__(self):
+        self.rules = []
+
+    def add(self, name, value):
+        self.rules.append(("add", name, value))
+        return self
+
+    def remove(self, name):
+        self.rules.append(("remove", name, None))
+        return self
+
+    def set(self, name, value):
+        self.rules.append(("set", name, value))
+        return self
+
+    def __call__(self, message):
+        for action, name, value in self.rules:
+            if action == "remove":
+                message.remove(name)
+                continue
+            if callable(value):
+                value = value(message)
+            if value is not None:
+                getattr(message, action)(name, value)
+
+
+class HttpParser(object):
+    """ read HTTP messages from a RewriteIO.
+
+    The parser reading responses finds the method of the matching
+    request, and so if a body follows, from the parser reading the
+    other direction of the connection. Data is read from `source` when
+    it's given, an object with a `readinto` method. """
+
+    def __init__(self, pipe, kind=REQUEST, buffer_size=BUFFER_SIZE,
+            max_header_size=MAX_HEADER_SIZE, source=None):
+        self.pipe = pipe
+        self.source = source or pipe
+        self.kind = kind
+        self.max_header_size = max_header_size
+        self.buf = bytearray(buffer_size)
+        self.start = 0
+        self.end = 0
+
+        # methods of the requests waiting for a response
+        self.methods = []
+        pipe.http = self
+
+    def fill(self):
+        """ receive more data, return False at the end of the stream.
+        The buffer is never resized in place so slices already returned
+        stay valid. """
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif self.end == len(self.buf):
+            pending = self.end - self.start
+            buf = bytearray(max(len(self.buf), 2 * pending))
+            buf[:pending] = memoryview(self.buf)[self.start:self.end]
+            self.buf = buf
+            self.start, self.end = 0, pending
+
+        recved = self.source.readinto(memoryview(self.buf)[self.end:])
+        if not recved:
+            return False
+        self.end += recved
+        return True
+
+    def read_message(self):
+        """ return the next message or None when the stream ends
+        between two messages """
+        raw = self.read_header_block()
+        if raw is None:
+            return None
+
+        message = parse_header_block(self.kind, raw)
+        if self.kind == REQUEST:
+            self.request_body(message)
+        else:
+            self.response_body(message)
+        return message
+
+    def read_header_block(self):
+        scanned = 0
+        while True:
+            # empty lines are allowed before a message
+            while self.start < self.end and self.buf[self.start] in (13, 10):
+                self.start += 1
+                scanned = 0
+
+            if self.start < self.end:
+                pos = max(self.start, self.start + scanned - 2)
+                end = _find_end(self.buf, pos, self.end)
+                if end >= 0:
+                    raw = bytes(self.buf[self.start:end])
+                    self.start = end
+                    return raw
+
+                scanned = self.end - self.start
+                if scanned > self.max_header_size:
+                    raise HttpError("header block too large")
+
+            if not self.fill():
+                if self.start < self.end:
+                    raise HttpError("incomplete header block")
+                return None
+
+    def request_body(self, message):
+        self.methods.append(message.method)
+        if message.method == "CONNECT" or message.get("upgrade"):
+            # whatever follows may not be HTTP anymore
+            message.length = None
+            return
+
+        message.keep_alive = should_keep_alive(message)
+        te = message.tokens("transfer-encoding")
+        if te:
+            if te[-1] != "chunked":
+                raise HttpError("unsupported transfer encoding")
+            message.chunked = True
+        else:
+            message.length = content_length(message) or 0
+
+    def response_body(self, message):
+        status = message.status
+        if 100 <= status < 200 and status != 101:
+            message.interim = True
+            message.keep_alive = True
+            return
+
+        method = None
+        requests = getattr(self.pipe.peer, 'http', None)
+        if requests is not None and requests.methods:
+            method = requests.methods.pop(0)
+
+        if status == 101 or (method == "CONNECT" and 200 <= status < 300):
+            message.length = None
+            return
+
+        message.keep_alive = should_keep_alive(message)
+        if method == "HEAD" or status in (204, 304):
+            return
+
+        te = message.tokens("transfer-encoding")
+        if te and te[-1] == "chunked":
+            message.chunked = True
+        elif te:
+            message.length = None
+        else:
+            message.length = content_length(message)
+
+        if message.length is None:
+            # the body ends with the connection
+            message.keep_alive = False
+
+    def body(self, message):
+        """ yield the body of `message` as received, chunked bodies
+        included. Slices of the buffer are returned, they are only
+        valid until the next one is asked. """
+        if message.chunked:
+            return self.chunked_body()
+        elif message.length is None:
+            return self.raw_body()
+        return self.fixed_body(message.length)
+
+    def fixed_body(self, length):
+        while length:
+            if self.start == self.end and not self.fill():
+                raise HttpError("incomplete body")
+            end = min(self.end, self.start + length)
+            data = memoryview(self.buf)[self.start:end]
+            length -= end - self.start
+            self.start = end
+            yield data
+
+    def raw_body(self):
+        while self.start < self.end or self.fill():
+            data = memoryview(self.buf)[self.start:self.end]
+            self.start = self.end
+            yield data
+
+    def chunked_body(self):
+        while True:
+            line = self.read_line()
+            try:
+                size = int(line.split(";", 1)[0].strip(), 16)
+            except ValueError:
+                raise HttpError("invalid chunk size: %r" % line)
+            yield line
+            if not size:
+                break
+
+            for data in self.fixed_body(size):
+                yield data
+            line = self.read_line()
+            if line.strip():
+                raise HttpError("invalid chunk end")
+            yield line
+
+        # trailers end with an empty line
+        while True:
+            line = self.read_line()
+            yield line
+            if not line.strip():
+                break
+
+    def read_line(self):
+        scanned = 0
+        while True:
+            idx = self.buf.find("\n", self.start + scanned, self.end)
+            if idx >= 0:
+                line = bytes(self.buf[self.start:idx + 1])
+                self.start = idx + 1
+                return line
+
+            scanned = self.end - self.start
+            if scanned > self.max_header_size:
+                raise HttpError("line too long")
+            if not self.fill():
+                raise HttpError("incomplete chunk")
+
+    def relay(self, message):
+        """ send `message` and its body to the other end of the pipe """
+        write = self.pipe.write
+        write(message.header_block())
+        for data in self.body(message):
+            write(data)
+
+    def messages(self, rewrite=None, end=None):
+        """ yield the header blocks, rewritten by `rewrite`, and the
+        bodies of the messages until the stream ends or can't be kept
+        alive. `end_message` is called on the pipe once the consumer
+        asks for the data following a message, unless `end` is given:
+        it's then yielded after each message and the consumer calls
+        `end_message` once the data before it has been written.
+
+        Requests are read until the client closes the connection, even
+        after the last one: returning would end the relay before the
+        response came back. Data following it is relayed as is. """
+        try:
+            while True:
+                message = self.read_message()
+                if message is None:
+                    return
+
+                if rewrite is not None:
+                    rewrite(message)
+                yield message.header_block()
+                for data in self.body(message):
+                    yield data
+                if message.interim:
+                    continue
+                if not message.keep_alive:
+                    if self.kind == REQUEST:
+                        for data in self.raw_body():
+                            yield data
+                    return
+                if end is None:
+                    self.pipe.end_message()
+                else:
+                    yield end
+        except HttpError, e:
+            log.debug("invalid HTTP %s: %s" % (self.kind, str(e)))
+
+
+def relay_messages(pipe, kind, rewrite=None):
+    """ relay the HTTP messages read from `pipe` until the connection
+    ends or can't be kept alive. `rewrite` is called with each message
+    before it's sent, it can be a `HeaderRules` instance. """
+    write = pipe.write
+    try:
+        for data in HttpParser(pipe, kind).messages(rewrite):
+            write(data)
+    except socket.error:
+        pass
+
+
+def relay_requests(pipe, rewrite=None):
+    relay_messages(pipe, REQUEST, rewrite=rewrite)
+
+
+def relay_responses(pipe, rewrite=None):
+    relay_messages(pipe, RESPONSE, rewrite=rewrite)
+
+
+def parse_header_block(kind, raw):
+    lines = raw.split("\n")
+    start_line = lines[0].rstrip("\r")
+    if kind == REQUEST:
+        parts = start_line.split(" ")
+        if len(parts) != 3:
+            raise HttpError("invalid request line: %r" % start_line)
+        start_line = (parts[0], parts[1], parse_version(parts[2]))
+    else:
+        parts = start_line.split(" ", 2)
+        if len(parts) < 2 or not parts[1].isdigit():
+            raise HttpError("invalid status line: %r" % start_line)
+        reason = len(parts) > 2 and parts[2] or ""
+        start_line = (parse_version(parts[0]), int(parts[1]), reason)
+
+    headers = []
+    for line in lines[1:]:
+        line = line.rstrip("\r")
+        if not line:
+            continue
+        if line[0] in " \t":
+            # obsolete line folding
+            if not headers:
+                raise HttpError("invalid header: %r" % line)
+            headers[-1][1] += " " + line.strip()
+            continue
+
+        try:
+            name, value = line.split(":", 1)
+        except ValueError:
+            raise HttpError("invalid header: %r" % line)
+        name = name.strip()
+        if not name:
+            raise HttpError("invalid header: %r" % line)
+        headers.append([name, value.strip()])
+    return HttpMessage(kind, raw, start_line, headers)
+
+
+def parse_version(version):
+    try:
+        if not version.startswith("HTTP/"):
+            raise ValueError
+        major, minor = version[5:].split(".")
+        return (int(major), int(minor))
+    except ValueError:
+        raise HttpError("invalid version: %r" % version)
+
+
+def content_length(message):
+    """ value of the Content-Length header, None if it isn't set """
+    value = message.get("content-length")
+    if value is None:
+        return None
+    try:
+        length = int(value)
+    except ValueError:
+        length = -1
+    if length < 0:
+        raise HttpError("invalid content length: %r" % value)
+    return length
+
+
+def should_keep_alive(message):
+    connection = message.tokens("connection")
+    if message.version >= (1, 1):
+        return "close" not in connection
+    return "keep-alive" in connection
+
+
+def _find_end(buf, start, end):
+    """ return the offset following the empty line ending a header
+    block, or -1 """
+    found = []
+    for sep in ("\n\r\n", "\n\n"):
+        idx = buf.find(sep, start, end)
+        if idx >= 0:
+            found.append(idx + len(sep))
+    if not found:
+        return -1
+    return min(found)
@@ -20,8 +20,16 @@ monkey.noisy = False
 monkey.patch_all()
 
 
+from . import balancer
 from .client import ClientConnection
+from .files import FileCache
+from .health import HealthTable, HealthChecker
+from .resolver import Resolver
 from .route import Route
+from .sslcontext import ClientContexts, HandshakePool, HandshakeTimeout
+from .sslcontext import ThreadPool
+from .timer import TimerWheel
+from .upstream import UpstreamPool
 from . import util
 
 log = logging.getLogger(__name__)
@@ -30,21 +38,31 @@ log = logging.getLogger(__name__)
 class ProxyServer(StreamServer):
 
     def __init__(self, listener, script, backlog=None, 
-            spawn='default', **sslargs):
+            spawn='default', health=None, **sslargs):
         StreamServer.__init__(self, listener, backlog=backlog,
                 spawn=spawn, **sslargs)
         
         self.script = script
+        self.cfg = None
         self.nb_connections = 0
         self.route = None
         self.rewrite_request = None
         self.rewrite_response = None
+        self.timers = TimerWheel()
+        self.upstreams = None
+        self.resolver = None
+        self.files = None
+        self.ssl_contexts = ClientContexts()
+        self.handshakes = None
+        self.health = health
+        self.checker = None
 
     def handle_quit(self, *args):
         """Graceful shutdown. Stop accepting connections immediately and
-        wait as long as necessary for all connections to close.
+        wait for all connections to close, at most `cfg.drain_timeout`
+        seconds.
         """
-        gevent.spawn(self.stop)
+        gevent.spawn(self.stop, self.cfg.drain_timeout)
 
     def handle_exit(self, *args):
         """ Fast shutdown.Stop accepting connection immediatly and wait
@@ -83,12 +101,76 @@ class ProxyServer(StreamServer):
         if self.route is not None:
             return
 
-        self.route = Route(self.script) 
+        self.route = Route(self.script, cfg=self.cfg)
+        self.upstreams = UpstreamPool(self.timers,
+                maxidle=self.route.cfg.upstream_keepalive,
+                timeout=self.route.cfg.upstream_idle_timeout)
+        self.resolver = Resolver(ttl=self.route.cfg.dns_ttl,
+                negative_ttl=self.route.cfg.dns_negative_ttl,
+                stale_ttl=self.route.cfg.dns_stale_ttl,
+                maxsize=self.route.cfg.dns_cache_size)
+        self.files = FileCache(maxsize=self.route.cfg.file_cache_size,
+                revalidate=self.route.cfg.file_cache_revalidate)
+        self.init_health()
+        self.init_handshakes()
+
+    def init_handshakes(self):
+        cfg = self.route.cfg
+        if not self.ssl_enabled or not cfg.ssl_handshake_threads:
+            return
+        if ThreadPool is None:
+            log.warn("ssl_handshake_threads requires gevent 1.0")
+            return
+        self.handshakes = HandshakePool(cfg.ssl_handshake_threads,
+                maxsize=cfg.ssl_handshake_max,
+                timeout=cfg.ssl_handshake_timeout)
+
+    def init_health(self):
+        """ use the health table shared by the arbiter or our own """
+        cfg = self.route.cfg
+        if self.health is None:
+            self.health = HealthTable()
+        self.health.max_failures = cfg.health_max_failures
+        self.health.ejection_time = cfg.health_ejection_time
+
+        if cfg.health_check_interval:
+            send = expect = None
+            if cfg.health_check_send:
+                send = cfg.health_check_send.decode("string_escape")
+            if cfg.health_check_expect:
+                expect = cfg.health_check_expect.decode("string_escape")
+            self.checker = HealthChecker(self.health,
+                    lambda: [b.addr for b in balancer.all_backends()],
+                    cfg.health_check_interval,
+                    timeout=cfg.health_check_timeout, send=send,
+                    expect=expect)
 
     def start_accepting(self):
         self.init_route()
+        self.timers.start()
+        if self.checker is not None:
+            self.checker.start()
         super(ProxyServer, self).start_accepting()
 
+    def stop(self, timeout=None):
+        try:
+            super(ProxyServer, self).stop(timeout)
+        finally:
+            self.close_route()
+
+    def close_route(self):
+        """ release the greenlets, threads and file descriptors used by
+        the connections once they are all closed """
+        if self.checker is not None:
+            self.checker.stop()
+        if self.upstreams is not None:
+            self.upstreams.close()
+        if self.files is not None:
+            self.files.close()
+        if self.handshakes is not None:
+            self.handshakes.close()
+        self.timers.stop()
+
     def handle(self, socket, address):
         """ handle the connection """
         conn = ClientConnection(socket, address, self)
@@ -96,7 +178,16 @@ class ProxyServer(StreamServer):
 
     def wrap_socket_and_handle(self, client_socket, address):
         # used in case of ssl sockets
-        ssl_socket = self.wrap_socket(client_socket, **self.ssl_args)
+        if self.handshakes is None:
+            ssl_socket = self.wrap_socket(client_socket, **self.ssl_args)
+        else:
+            try:
+                ssl_socket = self.handshakes.wrap_socket(self.wrap_socket,
+                        client_socket, **self.ssl_args)
+            except HandshakeTimeout:
+                log.warn("ssl handshake timeout")
+                client_socket.close()
+                return
         return self.handle(ssl_socket, address)
 
 def tcp_listener(address, backlog=None):
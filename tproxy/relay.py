@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -
+#
+# This file is part of tproxy released under the MIT license.
+# See the NOTICE for more information.
+
+import errno
+import socket
+import sys
+
+from gevent.hub import get_hub, Waiter
+
+from . import util
+
+READ = 1
+WRITE = 2
+
+_blocking_errnos = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+def can_relay(*socks):
+    """ return True if the connection can be relayed from a single
+    greenlet. io watchers are only available since gevent 1.0 and ssl
+    sockets need to go through their own recv/send. """
+    if not hasattr(get_hub(), 'loop'):
+        return False
+    for sock in socks:
+        if util.is_ssl_socket(sock):
+            return False
+    return True
+
+
+class Channel(object):
+    """ one direction of a relay. Data is read with recv_into in a
+    pooled buffer and written when `dest` is writable. Both happen in
+    the hub from io watchers callbacks. """
+
+    def __init__(self, relay, src, dest, timer=None):
+        self.relay = relay
+        self.timer = timer
+        self.src = src._sock
+        self.dest = dest._sock
+
+        loop = relay.hub.loop
+        self.reader = loop.io(src.fileno(), READ)
+        self.writer = loop.io(dest.fileno(), WRITE)
+
+        self.buf = relay.buffers.get()
+        self.view = memoryview(self.buf)
+        self.pending = None
+
+    def start(self):
+        self.reader.start(self.on_read)
+
+    def stop(self):
+        self.reader.stop()
+        self.writer.stop()
+
+    def release(self):
+        self.view = self.pending = None
+        self.relay.buffers.put(self.buf)
+
+    def on_read(self):
+        try:
+            recved = self.src.recv_into(self.buf)
+        except socket.error, e:
+            if e.args[0] in _blocking_errnos:
+                return
+            return self.relay.fail(sys.exc_info())
+
+        if not recved:
+            return self.relay.finish()
+
+        self.pending = self.view[:recved]
+        self.on_write()
+
+    def on_write(self):
+        try:
+            while self.pending:
+                sent = self.dest.send(self.pending)
+                self.pending = self.pending[sent:]
+        except socket.error, e:
+            if e.args[0] not in _blocking_errnos:
+                return self.relay.fail(sys.exc_info())
+
+            # wait until dest can accept more data before reading again
+            if not self.writer.active:
+                self.reader.stop()
+                self.writer.start(self.on_write)
+            return
+
+        if self.timer is not None:
+            self.timer.touch()
+
+        if self.writer.active:
+            self.writer.stop()
+            self.reader.start(self.on_read)
+
+
+class Relay(object):
+    """ relay both directions of a connection from the calling greenlet.
+
+    Data is moved by io watchers callbacks running in the hub, the
+    greenlet only switches once to wait until one side is closed or an
+    error happens. """
+
+    def __init__(self, client, server, buffers, timer=None,
+            response_timer=None):
+        self.hub = get_hub()
+        self.buffers = buffers
+        self.waiter = Waiter()
+        self.channels = (Channel(self, client, server, timer),
+                Channel(self, server, client, response_timer or timer))
+
+    def run(self):
+        try:
+            for channel in self.channels:
+                channel.start()
+            self.waiter.get()
+        finally:
+            for channel in self.channels:
+                channel.stop()
+                channel.release()
+
+    def stop(self):
+        for channel in self.channels:
+            channel.stop()
+
+    def finish(self):
+        self.stop()
+        self.waiter.switch(None)
+
+    def fail(self, exc_info):
+        self.stop()
+        self.waiter.throw(*exc_info)
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -
+#
+# This file is part of tproxy released under the MIT license.
+# See the NOTICE for more information.
+
+import logging
+import time
+
+import gevent
+from gevent import socket
+from gevent.event import AsyncResult
+
+from .cache import LRUCache
+from .util import is_ipv6
+
+log = logging.getLogger(__name__)
+
+
+def is_ip(host):
+    if is_ipv6(host):
+        return True
+    try:
+        socket.inet_pton(socket.AF_INET, host)
+    except socket.error:
+        return False
+    return True
+
+
+class Resolver(object):
+    """ per-worker cache of host name resolutions.
+
+    Addresses are kept `ttl` seconds, errors `negative_ttl` seconds. An
+    entry expired for less than `stale_ttl` seconds is still returned
+    while it's refreshed in the background. Concurrent lookups of the
+    same name wait for the same query. At most `maxsize` names are
+    kept. """
+
+    def __init__(self, ttl=60, negative_ttl=5, stale_ttl=300, maxsize=1024):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.stale_ttl = stale_ttl
+        self.cache = LRUCache(maxsize)
+        self.pending = {}
+
+    def resolve(self, addr):
+        """ return a list of (family, sockaddr) to connect to `addr` """
+        host, port = addr
+        if is_ip(host):
+            if is_ipv6(host):
+                return [(socket.AF_INET6, addr)]
+            return [(socket.AF_INET, addr)]
+
+        key = (host, port)
+        if self.ttl:
+            entry = self.cache.entry(key)
+            if entry is not None:
+                result, expires = entry
+                now = time.time()
+                if now < expires:
+                    return self._result(result)
+                if now < expires + self.stale_ttl and \
+                        not isinstance(result, Exception):
+                    # serve the stale addresses while refreshing them
+                    if key not in self.pending:
+                        gevent.spawn(self.query, key)
+                    return result
+
+        return self._result(self.query(key))
+
+    def _result(self, result):
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def query(self, key):
+        """ resolve `key`, waiting for the running query if any """
+        pending = self.pending.get(key)
+        if pending is not None:
+            return pending.get()
+
+        pending = self.pending[key] = AsyncResult()
+        try:
+            try:
+                infos = socket.getaddrinfo(key[0], key[1], 0,
+                        socket.SOCK_STREAM)
+            except socket.error, e:
+                log.debug("can't resolve %s: %s" % (key[0], str(e)))
+                result = e
+                self.store(key, e, self.negative_ttl)
+            else:
+                result = [(info[0], info[4]) for info in infos]
+                self.store(key, result, self.ttl)
+        except:
+            # killed while resolving, don't leave the others waiting
+            pending.set(socket.error("resolution of %s cancelled" %
+                key[0]))
+            raise
+        finally:
+            del self.pending[key]
+
+        pending.set(result)
+        return result
+
+    def store(self, key, result, ttl):
+        if not ttl:
+            return
+
+        if isinstance(result, Exception):
+            # keep serving a stale entry rather than the error
+            entry = self.cache.entry(key)
+            if entry is not None and not isinstance(entry[0], Exception) \
+                    and time.time() < entry[1] + self.stale_ttl:
+                return
+        self.cache.set(key, result, ttl)
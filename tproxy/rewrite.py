@@ -6,10 +6,13 @@
 import sys
 
 # backports socketio
+from collections import deque
 import io
-import inspect
 import socket
 
+from .buffers import sendall_chunks
+from .util import arity
+
 try:
     import errno
 except ImportError:
@@ -21,6 +24,9 @@ EWOULDBLOCK = getattr(errno, 'EWOULDBLOCK', 11)
 
 _blocking_errnos = ( EAGAIN, EWOULDBLOCK, EBADF)
 
+# writes are buffered until this many bytes are pending
+WRITE_BUFFER_SIZE = 65536
+
 if sys.version_info[:2] < (2, 7):
     # in python 2.6 socket.recv_into doesn't support bytesarray
     def _readinto(sock, b):
@@ -38,11 +44,13 @@ if sys.version_info[:2] < (2, 7):
                 if n in _blocking_errnos:
                     return None
                 raise
-    _get_memory = buffer
 else:
     _readinto = None
-    def _get_memory(string, offset):
-        return memoryview(string)[offset:]
+
+def _tobytes(b):
+    if isinstance(b, memoryview):
+        return b.tobytes()
+    return bytes(b)
 
 class RewriteIO(io.RawIOBase):
 
@@ -50,70 +58,133 @@ class RewriteIO(io.RawIOBase):
 
     It provides the raw I/O interface on top of a socket object.
     Backported from python 3.
+
+    Writes smaller than `write_buffer_size` are buffered and sent
+    together when `write_buffer_size` bytes are pending, when `flush` is
+    called, before waiting for data to read and when the pipe is closed.
+    Larger writes are sent right away without being copied.
     """
 
 
-    def __init__(self, src, dest, buf=None):
+    def __init__(self, src, dest, buf=None, timer=None,
+            write_buffer_size=WRITE_BUFFER_SIZE):
 
         io.RawIOBase.__init__(self)
         self._src = src
         self._dest = dest
+        self._timer = timer
+
+        # data received before the connection, consumed first
+        self._buf = deque(memoryview(chunk) for chunk in buf or [] if chunk)
+
+        self.write_buffer_size = write_buffer_size
+        self._wbuf = []
+        self._wbuf_size = 0
 
-        if not buf:
-            buf = []
-        self._buf = buf
+        # RewriteIO of the other direction and HTTP parser reading this
+        # one, set by tproxy.http
+        self.peer = None
+        self.http = None
+
+        # number of complete messages relayed, set by the script
+        self.messages = 0
+        self.at_boundary = True
         
     def readinto(self, b):
         self._checkClosed()
         self._checkReadable()
         
-        buf = bytes("".join(self._buf))
-
-        if buf and buf is not None:
-            l = len(b)
-            if len(self._buf) > l:
-                del b[l:]
+        if self._buf:
+            self.at_boundary = False
+            return self._read_buffered(b)
 
-                b[0:l], buf = buf[:l], buf[l:]
-                self._buf = [buf]
-                return len(b)
-            else:
-                length = len(buf)
-                del b[length:]
-                b[0:length] = buf
-                self._buf = []
-                return len(b) 
+        if self._wbuf:
+            # don't keep the peer waiting for what we wrote
+            self.flush()
 
         if _readinto is not None:
-            return _readinto(self._src, b)
-
-        while True:
-            try:
-                return self._src.recv_into(b)
-            except socket.error as e:
-                n = e.args[0]
-                if n == EINTR:
-                    continue
-                if n in _blocking_errnos:
-                    return None
-                raise
+            recved = _readinto(self._src, b)
+        else:
+            while True:
+                try:
+                    recved = self._src.recv_into(b)
+                    break
+                except socket.error as e:
+                    n = e.args[0]
+                    if n == EINTR:
+                        continue
+                    if n in _blocking_errnos:
+                        return None
+                    raise
+
+        if recved:
+            self.at_boundary = False
+            if self._timer is not None:
+                self._timer.touch()
+        return recved
+
+    def _read_buffered(self, b):
+        """ copy pending data to `b`. Each byte is only copied once,
+        whatever the size of the reads. """
+        size = len(b)
+        read = 0
+        while self._buf and read < size:
+            chunk = self._buf[0]
+            length = min(len(chunk), size - read)
+            b[read:read + length] = chunk[:length]
+            if length == len(chunk):
+                self._buf.popleft()
+            else:
+                self._buf[0] = chunk[length:]
+            read += length
+        return read
 
     def write(self, b):
         self._checkClosed()
         self._checkWritable()
 
-        try:
-            return self._dest.send(bytes(b))
-        except socket.error as e:
-            # XXX what about EINTR?
-            if e.args[0] in _blocking_errnos:
-                return None
-            raise
+        size = len(b)
+        if not size:
+            return 0
+
+        if size >= self.write_buffer_size:
+            # large writes are sent as they are, after the pending ones,
+            # so they are never copied
+            self.flush()
+            self._dest.sendall(b)
+            if self._timer is not None:
+                self._timer.touch()
+        else:
+            self._wbuf.append(_tobytes(b))
+            self._wbuf_size += size
+            if self._wbuf_size >= self.write_buffer_size:
+                self.flush()
+        self.at_boundary = False
+        return size
 
     def writeall(self, b):
-        sent = 0
-        while sent < len(b):
-            sent += self._dest.send(_get_memory(b, sent))
+        self.write(b)
+
+    def flush(self):
+        """ send the buffered writes """
+        self._checkClosed()
+        if not self._wbuf:
+            return
+
+        chunks = self._wbuf
+        self._wbuf = []
+        self._wbuf_size = 0
+        sendall_chunks(self._dest, chunks)
+        if self._timer is not None:
+            self._timer.touch()
+
+    def end_message(self):
+        """ tell tproxy that a complete message has been relayed. An
+        upstream connection kept alive is reused when both directions
+        relayed the same number of messages. """
+        self.flush()
+        self.messages += 1
+        self.at_boundary = True
 
     def readable(self):
         """True if the SocketIO is open for reading.
@@ -138,19 +209,30 @@ class RewriteIO(io.RawIOBase):
 class RewriteProxy(object):
 
     def __init__(self, src, dest, rewrite_fun, timeout=None,
-            extra=None, buf=None):
+            extra=None, buf=None, timer=None, pipes=None, with_extra=None):
         self.src = src
         self.dest = dest
         self.rewrite_fun = rewrite_fun
         self.timeout = timeout
         self.buf = buf
         self.extra = extra
+        self.timer = timer
+        self.pipes = pipes
+
+        # whether the function takes `extra`, resolved once by the route
+        if with_extra is None:
+            with_extra = arity(rewrite_fun) > 1
+        self.with_extra = with_extra
 
     def run(self):
-        pipe = RewriteIO(self.src, self.dest, self.buf) 
-        spec = inspect.getargspec(self.rewrite_fun)
+        pipe = RewriteIO(self.src, self.dest, self.buf, timer=self.timer)
+        if self.pipes is not None:
+            if self.pipes:
+                pipe.peer = self.pipes[-1]
+                self.pipes[-1].peer = pipe
+            self.pipes.append(pipe)
         try:
-            if len(spec.args) > 1:
+            if self.with_extra:
                 self.rewrite_fun(pipe, self.extra)
             else:
                 self.rewrite_fun(pipe)
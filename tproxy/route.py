@@ -3,53 +3,170 @@
 # This file is part of tproxy released under the MIT license. 
 # See the NOTICE for more information.
 
-import io
 import logging
 
+from .buffers import BufferPool, sendall
+from .cache import LRUCache
+from .config import Config
+from .relay import Relay
 from .rewrite import RewriteProxy
+from .splice import can_splice, async_splice
+from .table import RoutingTable, http_host
+from .tls import parse_client_hello
+from .util import arity
+
+
+def request_line_key(data):
+    idx = data.find("\r\n")
+    if idx < 0:
+        return None
+    return data[:idx]
+
+def host_key(data):
+    return http_host(data)[0]
+
+def sni_key(data):
+    try:
+        hello = parse_client_hello(data)
+    except ValueError:
+        return None
+    return hello and hello.sni
+
+# built-in keys a script can use as proxy_key
+PROXY_KEYS = {
+    "request_line": request_line_key,
+    "host": host_key,
+    "sni": sni_key
+}
 
 class Route(object):
     """ toute object to handle real proxy """
 
-    def __init__(self, script):
+    def __init__(self, script, cfg=None):
         if hasattr(script, "load"):
             self.script = script.load()
+        elif script is None:
+            # routes only come from the routing table
+            self.script = object()
         else:
             self.script = script
 
+        self.cfg = cfg or Config()
+        if self.cfg.routes:
+            self.table = RoutingTable.from_file(self.cfg.routes)
+        else:
+            self.table = None
+
+        self.has_script = (hasattr(self.script, 'proxy') or
+                hasattr(self.script, 'proxy_feed'))
+        self.incremental = hasattr(self.script, 'proxy_feed')
+        self.proxy_client = (hasattr(self.script, 'proxy') and
+                arity(self.script.proxy) > 1)
+
+        # decisions of scripts depending only on a key of the data
+        self.proxy_key = getattr(self.script, 'proxy_key', None)
+        if isinstance(self.proxy_key, basestring):
+            try:
+                self.proxy_key = PROXY_KEYS[self.proxy_key]
+            except KeyError:
+                raise ValueError("unknown proxy_key: %r" % self.proxy_key)
+        if self.proxy_key is not None and self.cfg.route_cache_size:
+            self.decisions = LRUCache(self.cfg.route_cache_size)
+        else:
+            self.decisions = None
+
         self.empty_buf = True
         if hasattr(self.script, 'rewrite_request'):
             self.proxy_input = self.rewrite_request
+            self.request_extra = arity(self.script.rewrite_request) > 1
             self.empty_buf = False
         else:
             self.proxy_input = self.proxy_io
 
         if hasattr(self.script, 'rewrite_response'):
             self.proxy_connected = self.rewrite_response
+            self.response_extra = arity(self.script.rewrite_response) > 1
         else:
             self.proxy_connected = self.proxy_io
 
+        # splice is only used when data is relayed untouched
+        self.use_splice = (self.proxy_input == self.proxy_io and
+                self.proxy_connected == self.proxy_io)
+
+        # each connection holds a buffer per direction
+        self.buffers = BufferPool(self.cfg.buffer_size,
+                2 * self.cfg.worker_connections)
+        self.use_relay = self.use_splice and self.cfg.relay == "single"
+
         self.log = logging.getLogger(__name__)
 
-    def proxy(self, data):
+    def proxy(self, data, client=None):
+        if self.decisions is None:
+            return self.call_proxy(data, client)
+
+        key = self.proxy_key(data)
+        if key is None:
+            return self.call_proxy(data, client)
+
+        commands = self.decisions.get(key)
+        if commands is None:
+            commands = self.call_proxy(data, client)
+            if cacheable(commands):
+                self.decisions.set(key, commands,
+                        self.cfg.route_cache_ttl or None)
+        return commands
+
+    def call_proxy(self, data, client=None):
+        if self.proxy_client:
+            return self.script.proxy(data, client)
         return self.script.proxy(data)
 
-    def proxy_io(self, src, dest, buf=None, extra=None):
-        while True:
-            data = src.recv(io.DEFAULT_BUFFER_SIZE)
-            if not data: 
-                break
-            self.log.debug("got data from input")
-            dest.sendall(data)
+    def proxy_feed(self, chunk, state):
+        return self.script.proxy_feed(chunk, state)
 
-    def rewrite(self, src, dest, fun, buf=None, extra=None):
-        rwproxy = RewriteProxy(src, dest, fun, extra=extra, buf=buf)
+    def proxy_io(self, src, dest, buf=None, extra=None, timer=None,
+            pipes=None):
+        if self.use_splice and can_splice(src, dest):
+            return async_splice(src, dest, timer=timer)
+
+        buf = self.buffers.get()
+        try:
+            view = memoryview(buf)
+            while True:
+                recved = src.recv_into(buf)
+                if not recved:
+                    break
+                self.log.debug("got data from input")
+                sendall(dest, view[:recved])
+                if timer is not None:
+                    timer.touch()
+        finally:
+            self.buffers.put(buf)
+
+    def relay(self, client, server, timer=None, response_timer=None):
+        Relay(client, server, self.buffers, timer=timer,
+                response_timer=response_timer).run()
+
+    def rewrite(self, src, dest, fun, buf=None, extra=None, timer=None,
+            pipes=None, with_extra=None):
+        rwproxy = RewriteProxy(src, dest, fun, extra=extra, buf=buf,
+                timer=timer, pipes=pipes, with_extra=with_extra)
         rwproxy.run()
 
-    def rewrite_request(self, src, dest, buf=None, extra=None):
+    def rewrite_request(self, src, dest, buf=None, extra=None, timer=None,
+            pipes=None):
         self.rewrite(src, dest, self.script.rewrite_request, buf=buf,
-                extra=extra)
+                extra=extra, timer=timer, pipes=pipes,
+                with_extra=self.request_extra)
         
-    def rewrite_response(self, src, dest, extra=None):
+    def rewrite_response(self, src, dest, extra=None, timer=None,
+            pipes=None):
         self.rewrite(src, dest, self.script.rewrite_response, 
-                extra=extra)
+                extra=extra, timer=timer, pipes=pipes,
+                with_extra=self.response_extra)
+
+def cacheable(commands):
+    """ commands that don't depend on the data can be reused """
+    if not isinstance(commands, dict):
+        return False
+    return 'data' not in commands and 'file' not in commands
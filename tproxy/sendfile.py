@@ -1,42 +1,93 @@
 # -*- coding: utf-8 -
 #
-# This file is part of tproxy released under the MIT license. 
+# This file is part of tproxy released under the MIT license.
 # See the NOTICE for more information.
 
 import errno
-import io
+import mmap
 import os
+import socket
 try:
     from os import sendfile
 except ImportError:
     try:
         from _sendfile import sendfile
     except ImportError:
-        def sendfile(fdout, fdin, offset, nbytes):
-            fsize = os.fstat(fdin).st_size
+        sendfile = None
 
-            # max to send
-            length = min(fsize-offset, nbytes)
+from gevent.socket import wait_write
+
+from .util import is_ssl_socket
 
-            with os.fdopen(fdin) as fin:          
-                fin.seek(offset)
+# size of the slices of a mapped file given to send
+CHUNK_SIZE = 65536
 
-                while length > 0:
-                    l = min(length, io.DEFAULT_BUFFER_SIZE)
-                    os.write(fdout, fin.read(l))
-                    length = length - l
+try:
+    memoryview(mmap.mmap(-1, 1))
+    def _window(mm, start, size):
+        return memoryview(mm)[start:start + size]
+    def _tobytes(window):
+        return window.tobytes()
+except TypeError:
+    # python 2 mmaps only have the old buffer interface
+    def _window(mm, start, size):
+        return buffer(mm, start, size)
+    _tobytes = str
 
-            return length
 
-from gevent.socket import wait_write
+class corked(object):
+    """ hold partial frames of a plain TCP socket until the block exits
+    so headers and data sent separately leave in the same packets.
+    Does nothing where TCP_CORK isn't available. """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.active = False
+
+    def __enter__(self):
+        if hasattr(socket, 'TCP_CORK') and not is_ssl_socket(self.sock):
+            try:
+                self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 1)
+                self.active = True
+            except socket.error:
+                # not a TCP socket
+                pass
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.active:
+            try:
+                self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 0)
+            except socket.error:
+                pass
+            self.active = False
+
+
+def send_file(sock, fdin, offset, nbytes, header=None):
+    """ send `header` then `nbytes` of `fdin` from `offset` to a socket
+    without copying the file in Python when possible.
+
+    sendfile is used for plain sockets, the socket is corked so the
+    header goes in the same packet as the start of the file. Ssl sockets,
+    or when sendfile isn't available, get slices of the file mapped in
+    memory. """
+    if sendfile is not None and not is_ssl_socket(sock):
+        with corked(sock):
+            if header:
+                sock.sendall(header)
+            return async_sendfile(sock.fileno(), fdin, offset, nbytes)
+    return mmap_sendfile(sock, fdin, offset, nbytes, header=header)
 
 
 def async_sendfile(fdout, fdin, offset, nbytes):
     total_sent = 0
     while total_sent < nbytes:
         try:
-            sent = sendfile(fdout, fdin, offset + total_sent, 
+            sent = sendfile(fdout, fdin, offset + total_sent,
                     nbytes - total_sent)
+            if not sent:
+                # end of file
+                break
             total_sent += sent
         except OSError, e:
             if e.args[0] == errno.EAGAIN:
@@ -44,3 +95,36 @@ def async_sendfile(fdout, fdin, offset, nbytes):
             else:
                 raise
     return total_sent
+
+
+def mmap_sendfile(sock, fdin, offset, nbytes, chunk_size=CHUNK_SIZE,
+        header=None):
+    """ send a file mapped in memory. The socket waits cooperatively
+    until it can send each slice. A small `header` is sent with the
+    first slice. """
+    nbytes = min(nbytes, os.fstat(fdin).st_size - offset)
+    if nbytes <= 0:
+        if header:
+            sock.sendall(header)
+        return 0
+
+    # the offset of a mapping must be a multiple of the granularity
+    start = offset - offset % mmap.ALLOCATIONGRANULARITY
+    mm = mmap.mmap(fdin, offset - start + nbytes, access=mmap.ACCESS_READ,
+            offset=start)
+    window = None
+    try:
+        pos = offset - start
+        end = pos + nbytes
+        if header:
+            first = min(max(chunk_size - len(header), 0), end - pos)
+            sock.sendall(header + _tobytes(_window(mm, pos, first)))
+            pos += first
+        while pos < end:
+            window = _window(mm, pos, min(chunk_size, end - pos))
+            pos += sock.send(window)
+            window = None
+    finally:
+        window = None
+        mm.close()
+    return nbytes
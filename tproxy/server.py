@@ -4,12 +4,14 @@
 # See the NOTICE for more information.
 
 import logging
+import time
 
 import greenlet
 import gevent
 from gevent.event import Event
 from gevent.pool import Group, Pool
 
+from .relay import can_relay
 
 class InactivityTimeout(Exception):
     """ Exception raised when the configured timeout elapses without
@@ -25,17 +27,38 @@ class Peers(Group):
             self._killing = True
             gevent.spawn(self.kill)
 
+class FirstByte(object):
+    """ timer proxy calling `callback` the first time data is relayed
+    """
+
+    def __init__(self, timer, callback):
+        self.timer = timer
+        self.callback = callback
+
+    def touch(self):
+        if self.callback is not None:
+            callback, self.callback = self.callback, None
+            callback()
+        if self.timer is not None:
+            self.timer.touch()
+
 class ServerConnection(object):
 
     def __init__(self, sock, client, timeout=None, extra=None,
-            buf=None):
+            buf=None, pool_key=None, backend=None):
         self.sock = sock
         self.timeout = timeout
         self.client = client
         self.extra = extra
         self.buf = buf
+        self.pool_key = pool_key
+        self.backend = backend
+        self.pipes = []
 
         self.route = client.route
+        self.timer = None
+        self.response_timer = None
+        self.started = None
 
         self.log = logging.getLogger(__name__)
         self._stopped_event = Event()
@@ -43,15 +66,71 @@ class ServerConnection(object):
     def handle(self):
         """ start to relay the response
         """
+        if self.timeout:
+            self.timer = self.client.worker.timers.add(self.timeout,
+                    self.expire, gevent.getcurrent())
+
+        self.response_timer = self.timer
+        if self.backend is not None:
+            # measure the time to the first byte of the response
+            self.started = time.time()
+            self.response_timer = FirstByte(self.timer, self.first_byte)
+
         try:
-            peers = Peers([
-                gevent.spawn(self.route.proxy_input, self.client.sock,
-                    self.sock, self.buf, self.extra),
-                gevent.spawn(self.route.proxy_connected, self.sock, 
-                    self.client.sock, self.extra)])
-            gevent.joinall(peers.greenlets)
+            if self.route.use_relay and can_relay(self.client.sock,
+                    self.sock):
+                self.route.relay(self.client.sock, self.sock,
+                        timer=self.timer,
+                        response_timer=self.response_timer)
+            else:
+                self.relay_peers()
         finally:
-            self.sock.close()
+            if self.timer is not None:
+                self.timer.cancel()
+
+            if self.pool_key is not None and self.reusable():
+                self.client.worker.upstreams.put(self.pool_key, self.sock)
+            else:
+                self.sock.close()
+
+    def reusable(self):
+        """ the upstream connection can be reused if the rewrite
+        functions of both directions stopped at the end of the same
+        message """
+        if len(self.pipes) != 2:
+            return False
+        req, resp = self.pipes
+        return (req.at_boundary and resp.at_boundary and
+                req.messages == resp.messages)
+
+    def relay_peers(self):
+        """ relay each direction in its own greenlet, until one of them
+        exits """
+        done = Event()
+        greenlets = [
+            gevent.spawn(self.route.proxy_input, self.client.sock,
+                self.sock, buf=self.buf, extra=self.extra,
+                timer=self.timer, pipes=self.pipes),
+            gevent.spawn(self.route.proxy_connected, self.sock,
+                self.client.sock, extra=self.extra,
+                timer=self.response_timer, pipes=self.pipes)]
+        for relay in greenlets:
+            relay.link(lambda g: done.set())
+        try:
+            done.wait()
+        finally:
+            # wait for both greenlets to exit so nothing uses the
+            # upstream connection once it's released
+            gevent.killall(greenlets, block=True)
+
+    def first_byte(self):
+        self.backend.observe(time.time() - self.started)
+
+    def expire(self, greenlet):
+        """ called by the timer wheel when no data has been relayed
+        for `timeout` seconds """
+        self.log.debug("no activity for %ss, closing" % self.timeout)
+        greenlet.kill(InactivityTimeout, block=False)
 
         
     def proxy_input(self, src, dest, buf, extra):
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -
+#
+# This file is part of tproxy released under the MIT license.
+# See the NOTICE for more information.
+
+import errno
+import os
+
+try:
+    from ._splice import splice, SPLICE_F_MOVE, SPLICE_F_NONBLOCK
+except ImportError:
+    splice = None
+
+from gevent.socket import wait_read, wait_write
+
+from . import util
+
+# size of the chunks moved through the pipe. It matches the default
+# capacity of a pipe on linux so a chunk never blocks on the pipe.
+PIPE_SIZE = 65536
+
+def can_splice(*socks):
+    """ return True if data between these sockets can be relayed with
+    splice(2) """
+    if splice is None:
+        return False
+    for sock in socks:
+        if util.is_ssl_socket(sock):
+            return False
+    return True
+
+def async_splice(src, dest, timer=None):
+    """ relay data from the socket `src` to the socket `dest` until
+    `src` is closed. Data is moved socket -> pipe -> socket inside the
+    kernel. `timer` is touched each time data is relayed. """
+    fdin = src.fileno()
+    fdout = dest.fileno()
+    flags = SPLICE_F_MOVE | SPLICE_F_NONBLOCK
+
+    pipe_r, pipe_w = os.pipe()
+    map(util.close_on_exec, (pipe_r, pipe_w))
+    try:
+        while True:
+            try:
+                pending = splice(fdin, pipe_w, PIPE_SIZE, flags)
+            except OSError, e:
+                if e.args[0] == errno.EAGAIN:
+                    wait_read(fdin)
+                    continue
+                raise
+
+            if not pending:
+                break
+
+            while pending > 0:
+                try:
+                    pending -= splice(pipe_r, fdout, pending, flags)
+                except OSError, e:
+                    if e.args[0] == errno.EAGAIN:
+                        wait_write(fdout)
+                    else:
+                        raise
+
+            if timer is not None:
+                timer.touch()
+    finally:
+        os.close(pipe_r)
+        os.close(pipe_w)
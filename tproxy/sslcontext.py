@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -
+#
+# This file is part of tproxy released under the MIT license.
+# See the NOTICE for more information.
+
+import logging
+import ssl
+
+import gevent
+from gevent import ssl as gssl
+from gevent.coros import BoundedSemaphore
+from gevent.socket import wait_read, wait_write
+try:
+    from gevent.threadpool import ThreadPool
+except ImportError:
+    # gevent < 1.0
+    ThreadPool = None
+
+from .cache import LRUCache
+from .config import ConfigError
+from .resolver import is_ip
+from .table import lookup_name
+
+log = logging.getLogger(__name__)
+
+# contexts are only used when gevent makes their sockets cooperative
+HAS_CONTEXT = hasattr(gssl, 'SSLContext')
+
+class HandshakeTimeout(Exception):
+    """ Exception raised when a TLS handshake takes too long """
+
+# wrap_socket arguments that aren't part of a context
+_WRAP_ARGS = ('do_handshake_on_connect', 'suppress_ragged_eofs')
+
+
+def make_context(ssl_args):
+    """ build a context from `ssl.wrap_socket` arguments """
+    protocol = ssl_args.get('ssl_version', ssl.PROTOCOL_SSLv23)
+    ctx = gssl.SSLContext(protocol)
+    ctx.verify_mode = ssl_args.get('cert_reqs', ssl.CERT_NONE)
+    if ssl_args.get('ca_certs'):
+        ctx.load_verify_locations(ssl_args['ca_certs'])
+    if ssl_args.get('certfile'):
+        ctx.load_cert_chain(ssl_args['certfile'], ssl_args.get('keyfile'))
+    if ssl_args.get('ciphers'):
+        ctx.set_ciphers(ssl_args['ciphers'])
+    return ctx
+
+
+def make_server_context(cfg):
+    """ build the context used by the workers to accept ssl
+    connections, or return None if the ssl module can't.
+
+    It's built by the arbiter before forking so all the workers share
+    the same session ticket keys. """
+    if not HAS_CONTEXT or not (cfg.ssl_keyfile and cfg.ssl_certfile):
+        return None
+
+    ssl_args = dict(keyfile=cfg.ssl_keyfile, certfile=cfg.ssl_certfile,
+            cert_reqs=cfg.ssl_cert_reqs, ca_certs=cfg.ssl_ca_certs)
+    ctx = make_context(ssl_args)
+    if not cfg.ssl_sni_certs:
+        return ctx
+
+    names = {}
+    for value in cfg.ssl_sni_certs:
+        try:
+            name, files = value.split("=", 1)
+        except ValueError:
+            raise ConfigError("invalid ssl_sni_cert: %r" % value)
+        files = files.split(",", 1)
+        names[name.lower()] = make_context(dict(ssl_args,
+            certfile=files[0], keyfile=files[-1]))
+
+    def select_cert(sslsock, server_name, initial_ctx):
+        if server_name:
+            selected = lookup_name(names, server_name.lower())
+            if selected is not None:
+                sslsock.context = selected
+
+    if hasattr(ctx, 'sni_callback'):
+        ctx.sni_callback = select_cert
+    elif hasattr(ctx, 'set_servername_callback'):
+        ctx.set_servername_callback(select_cert)
+    else:
+        log.warn("SNI isn't supported, ssl_sni_certs are ignored")
+    return ctx
+
+
+class ClientContexts(object):
+    """ per-worker cache of the contexts used to connect to remotes.
+
+    A context is built once for each set of ssl arguments so key and
+    certificates files are only loaded once. """
+
+    def __init__(self, maxsize=64):
+        self.contexts = LRUCache(maxsize)
+
+    def get_context(self, ssl_args):
+        """ return the key and the context of `ssl_args` """
+        key = tuple(sorted(ssl_args.items()))
+        ctx = self.contexts.get(key)
+        if ctx is None:
+            ctx = make_context(ssl_args)
+            self.contexts[key] = ctx
+        return key, ctx
+
+    def wrap_socket(self, sock, addr, **ssl_args):
+        """ wrap a socket not connected yet to `addr` """
+        if not HAS_CONTEXT:
+            return ssl.wrap_socket(sock, **ssl_args)
+
+        ctx_args, kwargs = _split_args(ssl_args)
+        _, ctx = self.get_context(ctx_args)
+        if getattr(ssl, 'HAS_SNI', False) and not is_ip(addr[0]):
+            kwargs['server_hostname'] = addr[0]
+        return ctx.wrap_socket(sock, **kwargs)
+
+
+def _split_args(ssl_args):
+    """ split wrap_socket arguments in context and socket arguments """
+    ctx_args = {}
+    sock_args = {}
+    for name, value in ssl_args.items():
+        if name in _WRAP_ARGS:
+            sock_args[name] = value
+        else:
+            ctx_args[name] = value
+    return ctx_args, sock_args
+
+
+class HandshakePool(object):
+    """ run the crypto of server side TLS handshakes in native threads.
+
+    The ssl module releases the GIL while OpenSSL works, so running
+    each handshake step in a thread keeps the hub relaying established
+    connections during handshake bursts. Waiting for the client still
+    happens in the hub. At most `maxsize` handshakes are in flight,
+    others wait for a slot. """
+
+    def __init__(self, threads, maxsize=100, timeout=10):
+        self.pool = ThreadPool(threads)
+        self.slots = BoundedSemaphore(maxsize)
+        self.timeout = timeout
+
+    def wrap_socket(self, wrap_socket, sock, **ssl_args):
+        ssl_args['do_handshake_on_connect'] = False
+        with gevent.Timeout(self.timeout, HandshakeTimeout):
+            with self.slots:
+                sslsock = wrap_socket(sock, **ssl_args)
+                self.handshake(sslsock)
+        return sslsock
+
+    def close(self):
+        self.pool.kill()
+
+    def handshake(self, sslsock):
+        while True:
+            error = self.pool.apply(_handshake_step, (sslsock._sslobj,))
+            if error is None:
+                return
+            elif error.args[0] == ssl.SSL_ERROR_WANT_READ:
+                wait_read(sslsock.fileno())
+            elif error.args[0] == ssl.SSL_ERROR_WANT_WRITE:
+                wait_write(sslsock.fileno())
+            else:
+                raise error
+
+
+def _handshake_step(sslobj):
+    """ run in a thread, errors are returned to the hub instead of being
+    reported by the thread pool """
+    try:
+        sslobj.do_handshake()
+    except ssl.SSLError, e:
+        return e
+    return None
@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -
+#
+# This file is part of tproxy released under the MIT license.
+# See the NOTICE for more information.
+
+import re
+import shlex
+
+from . import balancer
+from .config import ConfigError
+from .tls import parse_client_hello
+from .util import parse_address
+
+HOST_RE = re.compile(r"\r\nhost:[ \t]*([^\r\n]*)\r\n", re.I)
+
+# rule kinds by order of precedence
+KINDS = ("port", "sni", "host", "prefix")
+
+
+def http_host(data):
+    """ return the Host header of an HTTP request and True if no more data
+    can change the result """
+    idx = data.find("\r\n")
+    if idx < 0:
+        # wait for the request line unless it can't be an HTTP method
+        method = data[:16].split(" ", 1)[0]
+        return None, not (method.isalpha() and method.isupper())
+
+    if not data[:idx].endswith(("HTTP/1.0", "HTTP/1.1")):
+        # not HTTP
+        return None, True
+
+    m = HOST_RE.search(data, idx)
+    if m is not None:
+        host = m.group(1).strip().lower()
+        if host.startswith("["):
+            host = host.split("]")[0][1:]
+        else:
+            host = host.split(":")[0]
+        return host, True
+
+    return None, data.find("\r\n\r\n", idx) >= 0
+
+
+class PrefixTrie(object):
+    """ trie of literal prefixes. The longest matching prefix wins. """
+
+    def __init__(self):
+        self.root = {}
+
+    def __len__(self):
+        return len(self.root)
+
+    def add(self, prefix, value):
+        node = self.root
+        for c in prefix:
+            node = node.setdefault(c, {})
+        node[None] = value
+
+    def match(self, data):
+        node = self.root
+        found = None
+        for c in data:
+            node = node.get(c)
+            if node is None:
+                return found, True
+            found = node.get(None, found)
+
+        # we ran out of data, a longer prefix may still match
+        children = len(node) - (None in node)
+        if children:
+            return None, False
+        return found, True
+
+
+class RoutingTable(object):
+    """ routing rules compiled in lookup tables so a route can be found
+    without running the script.
+
+    The rules file contains one rule per line::
+
+        # kind  pattern         remote            options
+        port    8443            10.0.0.1:443      ssl=true
+        sni     *.example.com   10.0.0.4:443
+        host    example.com     10.0.0.2:80
+        host    *.example.com   10.0.0.3:80
+        prefix  "GET /_utils"   127.0.0.1:5984
+        host    db.example.com  10.0.1.1:5984,10.0.1.2:5984
+        pool    couch           10.0.2.1:5984,10.0.2.2:5984 policy=p2c
+        host    couch.local     pool:couch
+        pool    shards          10.0.3.1:80,10.0.3.2:80 policy=hash
+        host    *.shards.local  pool:shards       hash_by=host
+        default -               127.0.0.1:8000
+
+    Rules are tried by kind: the local port, then the server name of a
+    TLS ClientHello, then the HTTP Host header, then the longest literal
+    prefix of the data. Several remotes can be separated by commas.
+    Options are added to the returned commands. `pool` rules register a
+    balancer that other rules can use as ``pool:name``. """
+
+    def __init__(self):
+        self.ports = {}
+        self.snis = {}
+        self.hosts = {}
+        self.prefixes = PrefixTrie()
+        self.default = None
+
+    @classmethod
+    def from_file(cls, path):
+        table = cls()
+        with open(path) as f:
+            for lineno, line in enumerate(f):
+                try:
+                    args = shlex.split(line, comments=True)
+                    if args:
+                        table.add_rule(*args)
+                except (TypeError, ValueError, RuntimeError), e:
+                    raise ConfigError("%s:%s: invalid rule: %s" % (path,
+                        lineno + 1, str(e)))
+        return table
+
+    def add_rule(self, kind, pattern, remote, *options):
+        if kind == "pool":
+            return self.add_pool(pattern, remote, *options)
+
+        if remote.startswith("pool:"):
+            commands = {"pool": remote[5:]}
+        elif "," in remote:
+            commands = {"remote": map(parse_address, remote.split(","))}
+        else:
+            commands = {"remote": parse_address(remote)}
+
+        for option in options:
+            key, value = option.split("=", 1)
+            commands[key] = _parse_value(value)
+
+        if kind == "port":
+            self.ports[int(pattern)] = commands
+        elif kind == "sni":
+            self.snis[pattern.lower()] = commands
+        elif kind == "host":
+            self.hosts[pattern.lower()] = commands
+        elif kind == "prefix":
+            self.prefixes.add(pattern.decode("string_escape"), commands)
+        elif kind == "default":
+            self.default = commands
+        else:
+            raise ValueError("unknown rule kind: %r" % kind)
+
+    def add_pool(self, name, hosts, *options):
+        options = dict(option.split("=", 1) for option in options)
+        for key, value in options.items():
+            options[key] = _parse_value(value)
+        balancer.register(name, hosts.split(","), **options)
+
+    def match(self, data, port=None):
+        """ return the commands of the rule matching `data` received on
+        the local `port` and True if no more data can change the
+        result. """
+        for kind in KINDS:
+            commands, final = getattr(self, "match_%s" % kind)(data, port)
+            if commands is not None:
+                return commands, True
+            if not final:
+                return None, False
+        return self.default, True
+
+    def match_port(self, data, port):
+        return self.ports.get(port), True
+
+    def match_sni(self, data, port):
+        if not self.snis:
+            return None, True
+
+        try:
+            hello = parse_client_hello(data)
+        except ValueError:
+            return None, True
+        if hello is None:
+            return None, False
+        if hello.sni is None:
+            return None, True
+        return lookup_name(self.snis, hello.sni), True
+
+    def match_host(self, data, port):
+        if not self.hosts:
+            return None, True
+
+        host, final = http_host(data)
+        if host is None:
+            return None, final
+        return lookup_name(self.hosts, host), True
+
+    def match_prefix(self, data, port):
+        if not self.prefixes:
+            return None, True
+        return self.prefixes.match(data)
+
+
+def lookup_name(names, name):
+    """ find `name` in the dict `names`. Wildcards are tried from the
+    most specific domain. """
+    value = names.get(name)
+    if value is not None:
+        return value
+
+    labels = name.split(".")
+    for i in range(1, len(labels)):
+        value = names.get("*." + ".".join(labels[i:]))
+        if value is not None:
+            return value
+    return None
+
+def _parse_value(value):
+    if value.lower() in ("true", "false"):
+        return value.lower() == "true"
+    for kind in (int, float):
+        try:
+            return kind(value)
+        except ValueError:
+            pass
+    return value
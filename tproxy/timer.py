@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -
+#
+# This file is part of tproxy released under the MIT license.
+# See the NOTICE for more information.
+
+import logging
+import math
+import time
+
+import gevent
+
+log = logging.getLogger(__name__)
+
+
+class Timer(object):
+    """ timer registered in a `TimerWheel`. `touch` pushes the deadline
+    back without rescheduling anything. """
+
+    __slots__ = ('wheel', 'timeout', 'deadline', 'callback', 'args',
+            'slot', 'cancelled')
+
+    def __init__(self, wheel, timeout, callback, args):
+        self.wheel = wheel
+        self.timeout = timeout
+        self.callback = callback
+        self.args = args
+        self.slot = None
+        self.cancelled = False
+        self.touch()
+
+    def touch(self):
+        self.deadline = self.wheel.now + self.timeout
+
+    def cancel(self):
+        if not self.cancelled:
+            self.cancelled = True
+            self.wheel.remove(self)
+
+
+class TimerWheel(object):
+    """ hashed timer wheel shared by all the connections of a worker.
+
+    Timers are stored in `size` slots of `resolution` seconds. Touching a
+    timer only updates its deadline. When the wheel reaches the slot of
+    a timer, it is fired if its deadline passed or moved to the slot of
+    its new deadline, so maintaining a timer costs O(1) whatever the
+    number of connections. """
+
+    def __init__(self, resolution=1.0, size=512):
+        self.resolution = resolution
+        self.size = size
+        self.slots = [set() for i in range(size)]
+        self.tick = 0
+        self.now = time.time()
+        self._greenlet = None
+
+    def start(self):
+        if self._greenlet is None:
+            self._greenlet = gevent.spawn(self.run)
+
+    def stop(self):
+        if self._greenlet is not None:
+            self._greenlet.kill(block=False)
+            self._greenlet = None
+
+    def add(self, timeout, callback, *args):
+        """ call `callback(*args)` once `timeout` seconds elapsed
+        without the timer being touched """
+        timer = Timer(self, timeout, callback, args)
+        self.schedule(timer)
+        return timer
+
+    def schedule(self, timer):
+        ticks = int(math.ceil((timer.deadline - self.now) / self.resolution))
+        ticks = min(max(ticks, 1), self.size - 1)
+        timer.slot = (self.tick + ticks) % self.size
+        self.slots[timer.slot].add(timer)
+
+    def remove(self, timer):
+        if timer.slot is not None:
+            self.slots[timer.slot].discard(timer)
+            timer.slot = None
+
+    def run(self):
+        while True:
+            gevent.sleep(self.resolution)
+            self.now = time.time()
+            self.tick = (self.tick + 1) % self.size
+
+            expired = self.slots[self.tick]
+            self.slots[self.tick] = set()
+            for timer in expired:
+                timer.slot = None
+                if timer.deadline > self.now:
+                    self.schedule(timer)
+                    continue
+
+                timer.cancelled = True
+                try:
+                    timer.callback(*timer.args)
+                except Exception:
+                    log.exception("error in timer callback")
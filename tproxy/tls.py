@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -
+#
+# This file is part of tproxy released under the MIT license.
+# See the NOTICE for more information.
+
+import struct
+
+RECORD_HANDSHAKE = 0x16
+HANDSHAKE_CLIENT_HELLO = 0x01
+
+EXT_SERVER_NAME = 0x0000
+EXT_ALPN = 0x0010
+
+_record = struct.Struct(">BHH")
+_uint16 = struct.Struct(">H")
+_uint24 = struct.Struct(">BH")
+_extension = struct.Struct(">HH")
+
+
+class ClientHello(object):
+    """ fields of a TLS ClientHello used to route a connection """
+
+    __slots__ = ('version', 'sni', 'alpn')
+
+    def __init__(self, version, sni=None, alpn=None):
+        self.version = version
+        self.sni = sni
+        self.alpn = alpn or []
+
+    def __repr__(self):
+        return "<ClientHello sni=%r alpn=%r>" % (self.sni, self.alpn)
+
+
+def parse_client_hello(data):
+    """ parse the TLS ClientHello at the start of `data` without
+    copying it.
+
+    Return a `ClientHello` instance, None if more data is needed or
+    raise ValueError if data isn't a ClientHello. """
+    if len(data) < 1:
+        return None
+    if ord(data[0]) != RECORD_HANDSHAKE:
+        raise ValueError("not a TLS handshake")
+    if len(data) < 5:
+        return None
+
+    _, version, length = _record.unpack_from(data, 0)
+    if version >> 8 != 3:
+        raise ValueError("unsupported TLS version: %x" % version)
+    end = 5 + length
+    if len(data) < end:
+        return None
+
+    pos = 5
+    if ord(data[pos]) != HANDSHAKE_CLIENT_HELLO:
+        raise ValueError("not a ClientHello")
+    hi, lo = _uint24.unpack_from(data, pos + 1)
+    end = min(end, pos + 4 + (hi << 16 | lo))
+
+    try:
+        # client version, random
+        pos += 4
+        client_version = _uint16.unpack_from(data, pos)[0]
+        pos += 2 + 32
+
+        # session id, cipher suites, compression methods
+        pos += 1 + ord(data[pos])
+        pos += 2 + _uint16.unpack_from(data, pos)[0]
+        pos += 1 + ord(data[pos])
+
+        hello = ClientHello(client_version)
+        if pos >= end:
+            # no extensions
+            return hello
+
+        ext_end = min(end, pos + 2 + _uint16.unpack_from(data, pos)[0])
+        pos += 2
+        while pos + 4 <= ext_end:
+            ext_type, ext_len = _extension.unpack_from(data, pos)
+            pos += 4
+            if ext_type == EXT_SERVER_NAME:
+                hello.sni = _parse_server_name(data, pos, pos + ext_len)
+            elif ext_type == EXT_ALPN:
+                hello.alpn = _parse_alpn(data, pos, pos + ext_len)
+            pos += ext_len
+    except (IndexError, struct.error):
+        raise ValueError("invalid ClientHello")
+    return hello
+
+
+def _parse_server_name(data, pos, end):
+    pos += 2
+    while pos + 3 <= end:
+        name_type = ord(data[pos])
+        name_len = _uint16.unpack_from(data, pos + 1)[0]
+        pos += 3
+        if name_type == 0:
+            return data[pos:pos + name_len].lower()
+        pos += name_len
+    return None
+
+
+def _parse_alpn(data, pos, end):
+    protocols = []
+    pos += 2
+    while pos < end:
+        proto_len = ord(data[pos])
+        protocols.append(data[pos + 1:pos + 1 + proto_len])
+        pos += 1 + proto_len
+    return protocols
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -
+#
+# This file is part of tproxy released under the MIT license.
+# See the NOTICE for more information.
+
+import logging
+
+from gevent.select import select
+
+log = logging.getLogger(__name__)
+
+
+def pool_key(addr, is_ssl=False, ssl_args=None):
+    """ key identifying upstream connections that can be reused for each
+    other """
+    return (addr, is_ssl, tuple(sorted((ssl_args or {}).items())))
+
+def is_idle(sock):
+    """ return True if nothing can be read from an idle connection.
+    Data or EOF on a connection we don't read from means it can't be
+    reused. """
+    if getattr(sock, 'pending', None) and sock.pending():
+        return False
+    try:
+        readable = select([sock], [], [], 0)[0]
+    except Exception:
+        return False
+    return not readable
+
+
+class UpstreamPool(object):
+    """ per-worker pool of idle upstream connections.
+
+    At most `maxidle` connections are kept for each key and connections
+    are closed after `timeout` seconds without being reused. """
+
+    def __init__(self, timers, maxidle=10, timeout=30):
+        self.timers = timers
+        self.maxidle = maxidle
+        self.timeout = timeout
+        self.idle = {}
+
+    def get(self, key):
+        """ return an idle connection for `key` or None """
+        conns = self.idle.get(key)
+        while conns:
+            sock, timer = conns.pop()
+            timer.cancel()
+            if is_idle(sock):
+                log.debug("reuse connection to %s:%s" % key[0])
+                return sock
+            sock.close()
+        return None
+
+    def put(self, key, sock):
+        """ keep a connection at the end of a message for later use """
+        if not self.maxidle:
+            sock.close()
+            return
+
+        conns = self.idle.setdefault(key, [])
+        if len(conns) >= self.maxidle:
+            old, timer = conns.pop(0)
+            timer.cancel()
+            old.close()
+
+        timer = self.timers.add(self.timeout, self.expire, key, sock)
+        conns.append((sock, timer))
+
+    def expire(self, key, sock):
+        conns = self.idle.get(key, [])
+        for i, (conn, timer) in enumerate(conns):
+            if conn is sock:
+                del conns[i]
+                break
+        if not conns:
+            self.idle.pop(key, None)
+        sock.close()
+
+    def close(self):
+        for conns in self.idle.values():
+            for sock, timer in conns:
+                timer.cancel()
+                sock.close()
+        self.idle = {}
@@ -15,11 +15,14 @@ except ImportError:
     ctypes = None
 
 import fcntl
+import inspect
 import os
 import random
 import resource
 import socket
 
+from .cache import LRUCache
+
 # add support for gevent 1.0
 from gevent import version_info
 if version_info[0] >0:
@@ -41,18 +44,38 @@ if (hasattr(os, "devnull")):
 else:
    REDIRECT_TO = "/dev/null"
 
+# parsed addresses, remotes returned by scripts are often the same
+_ipv6 = LRUCache(1024)
+_addresses = LRUCache(1024)
+
 def is_ipv6(addr):
+    result = _ipv6.get(addr)
+    if result is None:
+        result = _ipv6[addr] = _is_ipv6(addr)
+    return result
+
+def _is_ipv6(addr):
     try:
         socket.inet_pton(socket.AF_INET6, addr)
     except socket.error: # not a valid address
         return False
     return True
-        
+
+def is_ssl_socket(sock):
+    """ return True if the socket is wrapped in an SSL layer """
+    return hasattr(sock, 'getpeercert')
 
 def parse_address(netloc, default_port=5000):
     if isinstance(netloc, tuple):
         return netloc
 
+    key = (netloc, default_port)
+    addr = _addresses.get(key)
+    if addr is None:
+        addr = _addresses[key] = _parse_address(netloc, default_port)
+    return addr
+
+def _parse_address(netloc, default_port=5000):
     # get host
     if '[' in netloc and ']' in netloc:
         host = netloc.split(']')[0][1:].lower()
@@ -157,3 +180,13 @@ def seed():
         random.seed(os.urandom(64))
     except NotImplementedError:
         random.seed(random.random())
+
+def arity(fun):
+    """ number of positional arguments of a function or method """
+    try:
+        args = inspect.getargspec(fun).args
+    except TypeError:
+        return 1
+    if inspect.ismethod(fun) and fun.im_self is not None:
+        return len(args) - 1
+    return len(args)
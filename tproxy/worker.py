@@ -25,11 +25,20 @@ class Worker(ProxyServer):
 
     PIPE = []
 
-    def __init__(self, age, ppid, listener, cfg, script):
+    def __init__(self, age, ppid, listener, cfg, script, health=None,
+            ssl_context=None):
         ProxyServer.__init__(self, listener, script, 
-                spawn=Pool(cfg.worker_connections))
+                spawn=Pool(cfg.worker_connections), health=health)
 
-        if cfg.ssl_keyfile and cfg.ssl_certfile:
+        if ssl_context is not None:
+            # shared with the other workers
+            self.wrap_socket = ssl_context.wrap_socket
+            self.ssl_args = dict(
+                    server_side = True,
+                    suppress_ragged_eofs=True,
+                    do_handshake_on_connect=True)
+            self.ssl_enabled = True
+        elif cfg.ssl_keyfile and cfg.ssl_certfile:
             self.wrap_socket = wrap_socket
             self.ssl_args = dict(
                     keyfile = cfg.ssl_keyfile,